@@ -5,26 +5,49 @@ Yet Another Pi Radio application.
 This is a multi-mode radio app for a Pi, for streaming from the internet or from a TV Headend server
 '''
 
+import abc
 import argparse
+import bisect
+import calendar
+import collections
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import configparser
+import cProfile
+import ctypes
+import ctypes.util
 import datetime
+import fcntl
+import difflib
+import hashlib
+import html
+import http.client
 import json
+import mmap
 import os
+import pstats
+import queue
 import re
+import shlex
+import shutil
 #import stat
 import signal
+import resource
+import socket
+import struct
 import sys
 import subprocess
+import tempfile
 import time
-from threading import Event, Thread
+import tracemalloc
+import wave
+from threading import Condition, Event, Lock, Thread, Timer, current_thread, setprofile
 import select
 import tty
 import termios
 
-import urllib
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-import requests
-from requests.auth import HTTPDigestAuth
+import urllib.parse
+# requests and http.server take a while to import on a Pi, so they are imported
+# where they are first needed rather than holding up the start of the radio
 
 # requires making code less readable:
 # Xpylint:disable=bad-whitespace
@@ -34,6 +57,7 @@ from requests.auth import HTTPDigestAuth
 # Xpylint:disable=too-many-statements
 # pylint:disable=global-statement
 # pylint:disable=multiple-statements
+# pylint:disable=import-outside-toplevel
 
 # broken in pylint3:
 # pylint:disable=global-variable-not-assigned
@@ -45,13 +69,97 @@ URL_GITHUB_HASH_SELF = 'https://api.github.com/repos/speculatrix/tvh_radio/tvh_r
 GOOGLE_TTS = 'http://translate.google.com/translate_tts?ie=UTF-8&client=tw-ob&tl=en&q='
 G_TTS_UA = 'VLC/3.0.2 LibVLC/3.0.2'
 
-KEYBOARD_POLL_TIMEOUT = 0.5
+CONTROL_SOCKET = 'control.sock'     # the control socket, under the settings directory
+CONTROL_LINE_MAX = 4096             # longest request line read from the control socket
+CONTROL_TIMEOUT = 10                # seconds a control request waits for the main loop
+WEB_COMMAND_TIMEOUT = 3             # seconds a web command waits for the main loop to do it
+WEB_EVENT_KEEPALIVE = 30            # seconds between keep-alives on the event stream
+WEB_LONG_POLL_MAX = 60              # longest wait allowed for a status long-poll
+WEB_ASSET_MAX_AGE = 30 * 24 * 3600  # seconds browsers may cache the web icons
+METRICS_PATH = '/metrics'           # where the web server gives Prometheus metrics
+METRICS_PREFIX = 'tvh_radio_'
+# histogram bucket upper bounds in seconds, from a key press up to a long listen
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300, 1800, 3600, 14400, )
+
+# commands posted to the main loop which don't come from a key
+CMD_MOVE = 'move'                   # a run of u and d, the argument is the net move
+CMD_TVH_UPDATE = 'tvh update'       # the argument is the new TVH channel map
+CMD_SEARCH = 'search'               # the argument is a channel name or number to jump to
+CMD_LIST_RELOAD = 'list reload'     # the argument is the name of the list file which changed
+CMD_PROFILE = 'profile'             # write the profile so far, posted on SIGUSR1
+
+NO_CHANS_TEXT = 'Warning, no channels in this mode yet'
+
+SEARCH_KEY = '/'                    # starts type-to-search on the keyboard
+SEARCH_FUZZY_CUTOFF = 0.6           # how close a fuzzy channel name match must be
+
+FEED_CHUNK = 4096                   # most bytes read from a stream at a time
+FEED_BUFFER = 512 * 1024            # bytes of a stream kept for a player to start with
+FEED_PLAYER_BACKLOG = 64 * 1024     # bytes behind live a player starts from, to fill its buffer
+PREBUFFER_MAX_SECS = 120            # an unused pre-buffered stream is closed after this
+RELAY_BACKLOG = 64 * 1024           # bytes behind live a relay listener starts from
+RELAY_PATH = '/stream'              # where the web server relays the playing stream
+RECORD_BUFFER = 256 * 1024          # bytes a recording collects before writing to disk
+# file extensions for recordings, by the stream's content type
+RECORD_EXTENSIONS = {
+    'audio/aac': 'aac',
+    'audio/aacp': 'aac',
+    'audio/mpeg': 'mp3',
+    'audio/ogg': 'ogg',
+    'application/ogg': 'ogg',
+    'video/mp2t': 'ts',
+}
+TIMESHIFT_REWIND_SECS = 10          # how far each rewind goes back
+TIMESHIFT_DEFAULT_RATE = 16 * 1024  # bytes per second assumed until measured, 128kbit/s
+TIMESHIFT_PIPE_BYTES = 16 * 1024    # pipe size asked for a timeshift player, about a second
+TIMESHIFT_PLAYER_SECS = 2           # seconds of audio a player is assumed to hold unplayed
+PIPE_DEFAULT_BYTES = 64 * 1024      # Linux pipe size, when it can't be read or changed
+PLAYER_KILL_TIMEOUT = 2             # seconds a player has to exit before being killed
+
+FAV_SAVE_DELAY = 2                  # seconds of no favourite changes before saving them
+PROBE_WORKERS = 8                   # internet streams probed at the same time
+PROBE_TIMEOUT = 5                   # seconds allowed to connect and for each read
+PROBE_BYTES = 16 * 1024             # bytes read after the first to measure throughput
+PROBE_REDIRECTS = 3                 # redirects followed to reach a stream
+
+PROFILE_TOP = 30                    # functions and allocation sites listed in a profile
+PROFILE_FRAMES = 10                 # stack frames kept for each memory allocation
+PROFILE_TRACEBACKS = 5              # largest allocation sites listed with their stack
+# cProfile can have a profile per thread until it moved to sys.monitoring in 3.12
+PROFILE_PER_THREAD = sys.version_info < (3, 12)
+
+LIST_POLL_SECS = 1                  # how often list files are checked without inotify
+# inotify event masks from <sys/inotify.h>, a file written and closed or renamed into place
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+TTS_DIR = 'tts'                     # spoken text cache, under the settings directory
+TTS_INDEX = 'index.json'
+TTS_INDEX_SAVE_DELAY = 5            # seconds after the last change the index is saved
+TTS_WORKERS = 2                     # announcements generated at the same time
+TTS_GOOGLE = 'google'
+TTS_TIMEOUT = 30                    # seconds allowed for some text to be turned into speech
+# local speech commands tried by the benchmark, {file} and {text} are substituted
+TTS_LOCAL_COMMANDS = (
+    'espeak-ng -w {file} {text}',
+    'espeak -w {file} {text}',
+    'pico2wave -w {file} {text}',
+)
+# the time is spoken by joining these, numbers and month names
+TTS_TIME_PHRASES = ('the time is', 'minutes past', 'on', )
+TTS_BENCH_TEXTS = (
+    'BBC Radio 4',
+    'the time is 25 minutes past 14, on Oct 18, 2026',
+)
 
 # string constants
 TS_URL_CHN = 'api/channel/grid'
 TS_URL_STR = 'stream/channel'
 TS_URL_PEG = 'api/passwd/entry/grid'
 TS_MAX_CHANS = 1600 # don't fetch more than this number of channels
+TS_PAGE_CHANS = 200  # channels asked for in each page of the channel grid
+TS_RETRY_SECS = 30  # seconds before fetching channels again after only some arrived
 
 # name of Tvheadend Server parameters
 TS_URL = 'ts_url'
@@ -61,8 +169,25 @@ TS_PAUTH = 'ts_pauth'
 TS_AUTH_TYPE='ts_auth_type'         # digest or plain authentication
 TS_CHN_LIMIT = 'ts_chn_lim'         # see TS_MAX_CHANS
 TS_PROFILE = 'pass'                 # use audio-only or pass
+TS_TIMEOUT_CONNECT = 'ts_timeout_connect'   # seconds to wait to connect to TVH
+TS_TIMEOUT_READ = 'ts_timeout_read' # seconds to wait for TVH to answer
+TS_RETRIES = 'ts_retries'           # times to retry a failed API call
+TS_REFRESH = 'ts_refresh'           # minutes between channel list refreshes
 
 PLAYER_COMMAND = 'player_command'
+PLAYER_STDIN = 'player_stdin'       # argument which makes the player read stdin
+PREBUFFER_IDLE = 'prebuffer_idle'   # seconds on a channel before pre-buffering it
+RELAY = 'relay'                     # read the stream ourselves and relay it on the web
+TIMESHIFT_MB = 'timeshift_mb'       # size of the pause and rewind buffer, 0 to disable
+RECORD_SPLIT_MINS = 'record_split_mins' # minutes of recording per file, 0 for no limit
+RECORD_SPLIT_MB = 'record_split_mb' # megabytes of recording per file, 0 for no limit
+RECORD_KEEP = 'record_keep'         # files of a recording kept, 0 to keep them all
+
+PROBE_INTERVAL = 'probe_interval'   # minutes between stream checks, 0 to disable
+PROBE_SKIP_DEAD = 'probe_skip_dead' # skip streams which failed their check on u/d
+
+TTS_ENGINE = 'tts_engine'          # google or a local command
+TTS_CACHE_MB = 'tts_cache_mb'      # disk space for spoken channel names
 
 WEB_PORT = 'web_port'              # default web port, 0 to disable, 8080 suggested
 WEB_PUBLIC = 'web_public'          # listen on all interfaces or localhost
@@ -78,12 +203,15 @@ SETTINGS_FILE = 'settings.ini'
 SETTINGS_SECTION = 'user'
 STREAMS_LIST = 'streams_list.dat'
 FAVOURITES_LIST = 'favourites_list.dat'
+TVH_CHAN_CACHE = 'tvh_channels.json'
+RECORDINGS_DIR = 'recordings'
+PROFILES_DIR = 'profiles'
 
-STREAMS_HDR = '''# restart tvh_radio after making changes made to this file
+STREAMS_HDR = '''# a running tvh_radio picks up changes to this file when it is saved
 # this is the streams list. hashes are comments.
 # the stream name is on one line, the next line is the URL.'''
 
-FAVOURITES_HDR = '''# DO NOT EDIT this file whilst tvh_radio is running!
+FAVOURITES_HDR = '''# a running tvh_radio picks up changes to this file when it is saved
 # this is the favourites list. hashes are comments.
 # the stream name is on one line, the next line is the URL.'''
 
@@ -123,6 +251,27 @@ SETTINGS_DEFAULTS = {
               'editing the user to set persistent auth on, then saving, then re-edit ' \
               'and scroll down to see the persistent auth value',
     },
+    TS_TIMEOUT_CONNECT: {
+        TITLE:  'Connect timeout',
+        DFLT:   '5',
+        HELP:   'Seconds to wait when connecting to the TV Headend Server',
+    },
+    TS_TIMEOUT_READ: {
+        TITLE:  'Read timeout',
+        DFLT:   '10',
+        HELP:   'Seconds to wait for the TV Headend Server to answer an API call',
+    },
+    TS_RETRIES: {
+        TITLE:  'Retries',
+        DFLT:   '2',
+        HELP:   'Number of times to retry a TV Headend API call which failed',
+    },
+    TS_REFRESH: {
+        TITLE:  'Channel refresh',
+        DFLT:   '15',
+        HELP:   'Minutes between checks for channels added or removed on the ' \
+                'TV Headend Server, 0 to only check at startup',
+    },
     PLAYER_COMMAND: {
         TITLE: 'Player',
         DFLT: '/usr/bin/omxplayer.bin -o alsa --threshold 2',
@@ -131,6 +280,80 @@ SETTINGS_DEFAULTS = {
               '"/usr/bin/omxplayer.bin -o alsa --threshold 2" or\n' \
               '"vlc -I dummy --novideo --play-and-exit"',
     },
+    PLAYER_STDIN: {
+        TITLE:  'Player stdin',
+        DFLT:   '',
+        HELP:   'Argument given to the player instead of a URL to make it play from ' \
+                'standard input, "-" for vlc, mpv or mpg123, "pipe:0" for omxplayer, ' \
+                'empty to choose from the player command',
+    },
+    PREBUFFER_IDLE: {
+        TITLE:  'Pre-buffer',
+        DFLT:   '0',
+        HELP:   'Seconds to stay on a channel before its stream is opened in the ' \
+                'background so playing it starts quickly, 0 to disable. With TVH ' \
+                'this may use a second tuner',
+    },
+    TTS_ENGINE: {
+        TITLE:  'Speech engine',
+        DFLT:   TTS_GOOGLE,
+        HELP:   'google, or a local command which writes a wav file, with {file} and ' \
+                '{text} where the file name and the text go, try:\n' \
+                '"espeak -w {file} {text}" or\n' \
+                '"pico2wave -w {file} {text}"\n' \
+                'run with --tts-benchmark to see which is quickest',
+    },
+    TTS_CACHE_MB: {
+        TITLE:  'Speech cache MB',
+        DFLT:   '20',
+        HELP:   'Megabytes of disk to use for spoken channel names, least recently ' \
+                'used are removed first',
+    },
+    RELAY: {
+        TITLE:  'Relay',
+        DFLT:   '0',
+        HELP:   'Set to 1 to read the playing stream once and give it to the player ' \
+                'and to anyone listening on the web port at %s, so extra listeners ' \
+                'don\'t need their own connection to the server' % (RELAY_PATH, ),
+    },
+    TIMESHIFT_MB: {
+        TITLE:  'Timeshift MB',
+        DFLT:   '0',
+        HELP:   'Megabytes of the playing stream to keep so it can be paused and ' \
+                'rewound, 0 to disable. 128kbit/s radio needs about 1MB a minute, ' \
+                'TV channels far more. It is kept in a temporary file, not in memory',
+    },
+    RECORD_SPLIT_MINS: {
+        TITLE:  'Recording minutes',
+        DFLT:   '60',
+        HELP:   'Minutes of a recording to put in each file before starting a new ' \
+                'one, 0 for no limit',
+    },
+    RECORD_SPLIT_MB: {
+        TITLE:  'Recording MB',
+        DFLT:   '0',
+        HELP:   'Megabytes of a recording to put in each file before starting a new ' \
+                'one, 0 for no limit',
+    },
+    RECORD_KEEP: {
+        TITLE:  'Recording files',
+        DFLT:   '0',
+        HELP:   'How many files of a recording to keep, the oldest are deleted as ' \
+                'new ones are started, 0 to keep them all',
+    },
+    PROBE_INTERVAL: {
+        TITLE:  'Probe interval',
+        DFLT:   '0',
+        HELP:   'Minutes between checks of every stream for how quickly it answers, ' \
+                '0 to disable. TVH channels are checked one at a time and not while ' \
+                'playing, so as not to take a tuner from the player',
+    },
+    PROBE_SKIP_DEAD: {
+        TITLE:  'Skip dead streams',
+        DFLT:   '0',
+        HELP:   'Set to 1 to skip streams which failed their last check when going ' \
+                'up and down the channels',
+    },
     WEB_PORT: {
         TITLE: 'Web Port',
         DFLT: '8080',
@@ -166,24 +389,53 @@ f - favourite or unfavourite a channel
 F - favourites list
 m - mode change - TVH, stream or favourites
 p - play/stop channel
+P - pause/resume, when the timeshift buffer is on
+b - go back %d seconds, when the timeshift buffer is on
 q - quit
+r - record/stop recording the channel playing, or the one chosen
 s - speak current channel name
 s - speak next channel name
 t - speak time
 u - up a channel
-'''
-
-VALID_WEB_COMMANDS = ('d', 'f', 'F', 'm', 'p', 's', 'S', 't', 'u', )
+/ - search, type a channel name, start of a name or number then enter
+''' % (TIMESHIFT_REWIND_SECS, )
+
+# the web interface icons, loaded from the images directory next to this script
+WEB_ASSET_DIR = 'images'
+WEB_ASSETS = (
+    'ball.red.png',
+    'down.png',
+    'forward.png',
+    'image1.png',
+    'sound1.png',
+    'up.png',
+    'world2.png',
+)
+
+VALID_WEB_COMMANDS = ('b', 'd', 'f', 'F', 'm', 'p', 'P', 'r', 's', 'S', 't', 'u', )
+# the control socket is only open to the user running the radio, so it can quit it
+CONTROL_COMMANDS = VALID_WEB_COMMANDS + ('q', )
 
 # web page head html with option to insert a string
 WEB_HEAD = '''<html>
 <head>
+    <meta charset="utf-8">
     <title>tvh_radio.py</title>
     <link rel="shortcut icon" type="image/png" href="%s"/>
     %s
 </head>
 '''
 
+# reloads the page when the state changes from the version it shows; browsers
+# without EventSource only get the refresh if the page is shown after a command
+WEB_PUSH = '''<script>
+    if (window.EventSource) {
+        var events = new EventSource('/api/events?since=%d');
+        events.onmessage = function() { events.close(); window.location.replace('/'); };
+    }
+    </script>
+    %s'''
+
 WEB_BODY = '''<body>
 <h1>tvh_radio.py</h1>
 
@@ -191,6 +443,11 @@ WEB_BODY = '''<body>
 <tr>
     <td colspan="2" align="center"><a href="/">update page</a></td>
 </tr>
+<tr>
+    <td colspan="2" align="center">
+        <form action="/" method="get"><input name="q" size="12" /> <input type="submit" value="find" /></form>
+    </td>
+</tr>
 %s
 <tr>
     <td align="right"><a href='/u'><img src="/images/up.png" /></a></td>
@@ -207,6 +464,16 @@ WEB_BODY = '''<body>
     <td>play/pause</td>
 </tr>
 
+<tr>
+    <td align="right"><a href='/P'>pause</a> <a href='/b'>back</a></td>
+    <td>pause/resume and rewind, with timeshift on</td>
+</tr>
+
+<tr>
+    <td align="right"><a href='/r'>record</a></td>
+    <td>record/stop recording</td>
+</tr>
+
 <tr>
     <td align="right"><a href='/f'><img src="/images/image1.png" /></a></td>
     <td>favourite toggle</td>
@@ -243,16 +510,30 @@ GLOBALS = {}
 # keys for the globals, hopefully to prevent typos, python will optimise
 # these as reference by hash so it's not expensive
 G_CHAN_NAME_FUTURE = 'channel name future'
+G_CHAN_URL_FUTURE = 'channel url future'
 G_CHAN_NUM_FUTURE = 'channel number future'
 G_CHAN_NAME_PLAYING = 'channel name playing'
 G_DBG_LEVEL     = 'debug_level'
-G_EVENT         = 'event handler'
-G_KEY_STROKE    = 'key_stroke'
+G_COMMANDS      = 'command queue'
 G_MY_SETTINGS   = 'my settings'
+G_METRICS       = 'metrics'
+G_PLAYER        = 'player supervisor'
 G_PLAYER_PID    = 'player_pid'
+G_PLAYING_FEED  = 'playing feed'
+G_PREBUFFER     = 'prebuffer'
+G_PROFILER      = 'profiler'
+G_PROBER        = 'stream prober'
 G_QUIT_FLAG     = 'quit_flag'
 G_RADIO_MODE    = 'radio_mode'
+G_RECORDER      = 'recorder'
+G_STATUS        = 'status'
+G_WEB_ASSETS    = 'web assets'
+G_SHUTDOWN      = 'shutdown event'
 G_STOP_PLAYBACK = 'stop playback'
+G_TIMESHIFT     = 'timeshift buffer'
+G_TTS_CACHE     = 'tts cache'
+G_TVH_CHAN_NUMBERS = 'tvh channel numbers'
+G_TVH_CLIENT    = 'tvh client'
 
 
 ##########################################################################################
@@ -262,24 +543,84 @@ def print_help():
 
     print(HELP_TEXT)
 
+##########################################################################################
+def get_setting(setting):
+    ''' returns the value of a setting, falling back to the default for any
+        setting added since the settings file was written '''
+
+    global GLOBALS
+
+    return GLOBALS[G_MY_SETTINGS].get(SETTINGS_SECTION, setting,
+                                      fallback=SETTINGS_DEFAULTS[setting][DFLT])
+
+
+##########################################################################################
+class TVHClient():
+    ''' client for the TVH API, holding one pooled keep-alive session so repeated
+        calls reuse the TCP connection, and with digest auth, the server nonce '''
+
+    def __init__(self):
+        self.ts_url = get_setting(TS_URL)
+        self.timeout = (float(get_setting(TS_TIMEOUT_CONNECT)), float(get_setting(TS_TIMEOUT_READ)))
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.auth import HTTPDigestAuth
+        from urllib3.util.retry import Retry
+
+        retries = Retry(total=int(get_setting(TS_RETRIES)),
+                        backoff_factor=0.5,
+                        status_forcelist=(502, 503, 504, ),
+                        allowed_methods=('GET', ))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retries)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if get_setting(TS_AUTH_TYPE) == 'plain':
+            self.session.auth = (get_setting(TS_USER), get_setting(TS_PASS))
+        else:
+            self.session.auth = HTTPDigestAuth(get_setting(TS_USER), get_setting(TS_PASS))
+
+    def get(self, api_path, params=None):
+        ''' does a GET of the api path relative to the server URL, returns the response '''
+
+        time_start = time.monotonic()
+        try:
+            return self.session.get(f'{ self.ts_url }/{ api_path }', params=params,
+                                    timeout=self.timeout)
+        finally:
+            GLOBALS[G_METRICS].tvh_api.observe(time.monotonic() - time_start, path=api_path)
+
+    def close(self):
+        ''' closes any pooled connections '''
+
+        self.session.close()
+
+
+TVH_CLIENT_LOCK = Lock()
+
+def get_tvh_client():
+    ''' returns the shared TVH client, making it on first use '''
+
+    global GLOBALS
+
+    with TVH_CLIENT_LOCK:
+        if GLOBALS[G_TVH_CLIENT] is None:
+            GLOBALS[G_TVH_CLIENT] = TVHClient()
+
+    return GLOBALS[G_TVH_CLIENT]
+
+
 ##########################################################################################
 def api_test_func():
     ''' secret function for testing the TVH API in various ways '''
 
     global GLOBALS
 
-    ts_url = GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_URL]
-    ts_auth_type = GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_AUTH_TYPE]
-    ts_user = GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_USER]
-    ts_pass = GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_PASS]
-    ts_query = f'{ ts_url }/{ TS_URL_PEG }'
-
-    if ts_auth_type == 'plain':
-        ts_response = requests.get(ts_query, auth=(ts_user, ts_pass))
-    else:
-        ts_response = requests.get(ts_query, auth=HTTPDigestAuth(ts_user, ts_pass))
+    ts_response = get_tvh_client().get(TS_URL_PEG)
 
-    print(f'<!-- api_test_func URL { ts_query } -->')
+    print(f'<!-- api_test_func URL { ts_response.url } -->')
     if ts_response.status_code != 200:
         print(f'>Error code { ts_response.status_code }\n{ ts_response.content }')
         return
@@ -296,6 +637,7 @@ def streams_editor():
     print('=== Streams List Editor ===')
     print('Please edit the file %s with your favourite editor' %
           (os.path.join(os.environ['HOME'], SETTINGS_DIR, STREAMS_LIST), ))
+    print('Changes are picked up as soon as the file is saved')
 
 ##########################################################################################
 def channel_editor(chan_map):
@@ -331,7 +673,11 @@ def print_channel_list(prefix, chan_list):
     '''
 
     for (chan_name, chan_url) in chan_list.items():
-        print(f'{ prefix }{ chan_name } : { chan_url }')
+        probe = GLOBALS[G_PROBER].result(chan_url) if GLOBALS[G_PROBER] else None
+        if probe:
+            print(f'{ prefix }{ chan_name } : { chan_url } : { probe_text(probe) }')
+        else:
+            print(f'{ prefix }{ chan_name } : { chan_url }')
 
 
 ##########################################################################################
@@ -340,29 +686,34 @@ def write_list_file(text_header, file_name, list_data):
 
     prints the text header, which is usually a comment
 
-    lines are then paired, the first is the name of the stream, the second is the URL
+    lines are then paired, the first is the name of the stream, the second is the URL;
+    an empty list leaves just the header
+
+    the file is written alongside and renamed over the old one, so a crash part way
+    through never leaves a truncated list
 
     returns True or False on Success or Failure
     '''
 
-    if not list_data:
+    tmp_file = f'{ file_name }.tmp'
+    try:
+        with open(tmp_file, 'w') as fh_list:
+            fh_list.write(text_header)
+            fh_list.write('\n')
+
+            for (stream_name, stream_url) in list_data.items():
+                fh_list.write(stream_name)
+                fh_list.write('\n')
+                fh_list.write(stream_url)
+                fh_list.write('\n')
+
+            fh_list.flush()
+            os.fsync(fh_list.fileno())
+        os.replace(tmp_file, file_name)
+    except OSError as write_err:
+        print(f'Error, streams listing file { file_name } was unwritable, { write_err }')
         return False
 
-    fh_list = open(file_name, 'w')
-    if not fh_list:
-        print(f'Error, streams listing file { file_name } was unwritable')
-        return False
-
-    fh_list.write(text_header)
-    fh_list.write('\n')
-
-    for (stream_name, stream_url) in list_data.items():
-        fh_list.write(stream_name)
-        fh_list.write('\n')
-        fh_list.write(stream_url)
-        fh_list.write('\n')
-
-    fh_list.close()
     return True
 
 ##########################################################################################
@@ -417,70 +768,382 @@ def read_list_file(file_name):
 def text_to_speech_file(input_text, output_file):
     ''' uses Google to turn supplied text into speech in the file '''
 
+    import urllib.request
+
     goo_url = f'{ GOOGLE_TTS }{ urllib.parse.quote(input_text) }'
     opener = urllib.request.build_opener()
     opener.addheaders = [('User-agent', G_TTS_UA), ]
 
-    write_handle = open(output_file, 'wb')
-    with opener.open(goo_url) as goo_handle:
+    with open(output_file, 'wb') as write_handle, \
+         opener.open(goo_url, timeout=TTS_TIMEOUT) as goo_handle:
         write_handle.write(goo_handle.read())
 
 
 ##########################################################################################
-def chan_data_to_tts_file(chan_name):
-    ''' given the channel data, returns the name of a sound file which is the
-        channel name; calls text_to_speech_file to generate it if required '''
+class TTSBackend(abc.ABC):
+    ''' base class of the ways of turning text into a sound file '''
+
+    name = ''
+    extension = 'mp3'
+
+    @abc.abstractmethod
+    def to_file(self, input_text, output_file):
+        ''' writes the text as speech into output_file, raises OSError on failure '''
+
+
+class TTSGoogle(TTSBackend):
+    ''' speech from the Google translate endpoint, needs the internet '''
+
+    name = TTS_GOOGLE
+    extension = 'mp3'
+
+    def to_file(self, input_text, output_file):
+        text_to_speech_file(input_text, output_file)
 
-    global GLOBALS
 
-    tts_file_name = f"{ os.path.join(os.environ['HOME'], SETTINGS_DIR, chan_name)}.mp3"
+class TTSCommand(TTSBackend):
+    ''' speech from a local command such as espeak or pico2wave writing a WAV file,
+        the command has {file} and {text} where the file and text go '''
 
-    if not os.path.isfile(tts_file_name):
-        text_to_speech_file(chan_name, tts_file_name)
+    extension = 'wav'
 
-    return tts_file_name
+    def __init__(self, command):
+        self.name = command
+        self.command_array = shlex.split(command)
+
+    def to_file(self, input_text, output_file):
+        tts_cmd_array = [arg.replace('{file}', output_file).replace('{text}', input_text)
+                         for arg in self.command_array]
+        try:
+            subprocess.run(tts_cmd_array, check=True, timeout=TTS_TIMEOUT,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as tts_err:
+            raise OSError(f'speech command failed, { tts_err }') from tts_err
+
+
+def make_tts_backend(tts_engine):
+    ''' returns the speech backend for the tts_engine setting '''
+
+    if tts_engine == TTS_GOOGLE:
+        return TTSGoogle()
+
+    return TTSCommand(tts_engine)
 
 
 ##########################################################################################
-def get_tvh_chan_urls():
-    ''' gets the channel listing and generates an ordered dict
-        returns dict: key = channel name, value = stream URL
-    '''
+def tts_benchmark():
+    ''' times how long each speech backend takes to produce a file, so the
+        quickest can be chosen; backends which fail, such as Google when
+        offline, are reported as unavailable '''
+
+    tts_engines = [TTS_GOOGLE, ]
+    for tts_engine in (get_setting(TTS_ENGINE), ) + TTS_LOCAL_COMMANDS:
+        if tts_engine not in tts_engines and \
+           (tts_engine == TTS_GOOGLE or shutil.which(shlex.split(tts_engine)[0])):
+            tts_engines.append(tts_engine)
+
+    print('=== Speech Benchmark ===')
+    with tempfile.TemporaryDirectory() as bench_dir:
+        for tts_engine in tts_engines:
+            backend = make_tts_backend(tts_engine)
+            timings = []
+            try:
+                for (text_num, bench_text) in enumerate(TTS_BENCH_TEXTS):
+                    bench_file = os.path.join(bench_dir, f'bench{ text_num }.{ backend.extension }')
+                    time_start = time.monotonic()
+                    backend.to_file(bench_text, bench_file)
+                    timings.append(time.monotonic() - time_start)
+            except OSError as tts_err:
+                print(f'{ tts_engine } : unavailable, { tts_err }')
+                continue
+
+            print(f'{ tts_engine } : min { min(timings) * 1000:.0f}ms, '
+                  f'mean { sum(timings) / len(timings) * 1000:.0f}ms, '
+                  f'max { max(timings) * 1000:.0f}ms')
 
-    global GLOBALS
 
-    ts_url = GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_URL]
-    ts_auth_type = GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_AUTH_TYPE]
-    ts_user = GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_USER]
-    ts_pass = GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_PASS]
-    ts_query = f'{ ts_url }/{ TS_URL_CHN }?limit={ GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_CHN_LIMIT] }'
+##########################################################################################
+class TTSCache():
+    ''' cache of spoken text; files are named by a hash of the text and listed
+        in an index, and the least recently used are removed when the cache is
+        over its disk budget. A thread pool generates announcements in advance. '''
+
+    def __init__(self, cache_dir, max_bytes, backend):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, TTS_INDEX)
+        self.lock = Lock()
+        self.pending = {}   # text hash => Future
+        self.timer = None   # saves the index a little after it changes
+        self.pool = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix='tts')
+
+        if not os.path.isdir(cache_dir):
+            os.mkdir(cache_dir)
+
+        # text hash => dict of text, size and time last used
+        self.index = {}
+        if os.path.isfile(self.index_file):
+            try:
+                with open(self.index_file, 'r') as fh_index:
+                    self.index = json.load(fh_index)
+            except (OSError, ValueError) as index_err:
+                print(f'Warning, speech cache index unreadable, { index_err }')
+        self.index = {tts_hash: entry for (tts_hash, entry) in self.index.items()
+                      if os.path.isfile(self.file_name(tts_hash))}
+
+        # speech generated since the index was last saved is adopted, anything left
+        # half written, or spoken by a different backend, is removed
+        unindexed = 0
+        for file_entry in os.scandir(cache_dir):
+            (tts_hash, _dot, extension) = file_entry.name.partition('.')
+            if tts_hash in self.index or not file_entry.is_file():
+                continue
+            if re.fullmatch(r'[0-9a-f]{40}', tts_hash) and extension == backend.extension:
+                file_stat = file_entry.stat()
+                self.index[tts_hash] = {'text': '', 'size': file_stat.st_size,
+                                        'used': file_stat.st_mtime, }
+            elif re.fullmatch(r'[0-9a-f]{40}', tts_hash) or tts_hash.startswith('tmp'):
+                try:
+                    os.remove(file_entry.path)
+                except OSError:
+                    pass
+            else:
+                continue
+            unindexed += 1
+        if unindexed:
+            print(f'Tidied up { unindexed } files missing from the speech cache index')
+            with self.lock:
+                self.schedule_save_locked()
+
+    def text_hash(self, text):
+        ''' returns the hash of the text and backend, which is safe to use in a file name '''
+
+        return hashlib.sha1(f'{ self.backend.name }\n{ text }'.encode('utf-8')).hexdigest()
+
+    def file_name(self, tts_hash):
+        ''' returns the full file name for the hash of some text '''
+
+        return os.path.join(self.cache_dir, f'{ tts_hash }.{ self.backend.extension }')
+
+    def get(self, text):
+        ''' returns the name of a sound file of the text being spoken, waiting for it
+            to be generated if necessary, or None if that failed '''
+
+        tts_hash = self.text_hash(text)
+        with self.lock:
+            entry = self.index.get(tts_hash)
+            if entry:
+                entry['used'] = time.time()
+                return self.file_name(tts_hash)
+            future = self.pending.get(tts_hash)
+            if future is None:
+                future = self.pool.submit(self.generate, text, tts_hash)
+                self.pending[tts_hash] = future
+
+        try:
+            return future.result(timeout=TTS_TIMEOUT)
+        except FutureTimeoutError:
+            print(f'Warning, "{ text }" took too long to turn into speech')
+            return None
+        except Exception as tts_err:    # pylint:disable=broad-except
+            print(f'Warning, couldn\'t turn "{ text }" into speech, { tts_err }')
+            return None
+
+    def get_joined(self, texts):
+        ''' returns the name of a new sound file of all the texts spoken in turn, made
+            by joining the cached speech of each, or None if that failed. Sentences
+            such as the time are rarely spoken twice, so the joined file isn't cached,
+            the caller removes it when it has been played '''
+
+        tts_files = [self.get(text) for text in texts]
+        if None in tts_files:
+            return None
+
+        # every caller joins into its own temporary file, one left by a crash is
+        # removed when the cache is next loaded
+        (tmp_handle, tmp_file) = tempfile.mkstemp(suffix=f'.{ self.backend.extension }',
+                                                  dir=self.cache_dir)
+        os.close(tmp_handle)
+        try:
+            join_audio_files(tts_files, tmp_file)
+        except (OSError, EOFError, wave.Error) as join_err:
+            print(f'Warning, couldn\'t join speech files, { join_err }')
+            os.remove(tmp_file)
+            return None
+
+        return tmp_file
+
+    def prewarm(self, texts):
+        ''' queues the generation of any of the texts not already cached '''
+
+        with self.lock:
+            for text in texts:
+                tts_hash = self.text_hash(text)
+                if tts_hash not in self.index and tts_hash not in self.pending:
+                    future = self.pool.submit(self.generate, text, tts_hash)
+                    self.pending[tts_hash] = future
+                    future.add_done_callback(self.prewarm_done)
+
+    @staticmethod
+    def prewarm_done(future):
+        ''' reports problems generating speech nobody is waiting for '''
+
+        if not future.cancelled() and future.exception() and GLOBALS[G_DBG_LEVEL]:
+            print(f'Debug, speech cache prewarm failed, { future.exception() }')
+
+    def generate(self, text, tts_hash):
+        ''' turns the text into speech in the cache, runs in the thread pool '''
+
+        tts_file = self.file_name(tts_hash)
+        tmp_file = os.path.join(self.cache_dir, f'{ tts_hash }.tmp.{ self.backend.extension }')
+        try:
+            self.backend.to_file(text, tmp_file)
+            os.replace(tmp_file, tts_file)
+            with self.lock:
+                self.index[tts_hash] = {'text': text, 'size': os.path.getsize(tts_file),
+                                        'used': time.time(), }
+                self.evict(tts_hash)
+                self.schedule_save_locked()
+        finally:
+            # whatever went wrong, the next get() tries again rather than getting the error
+            with self.lock:
+                del self.pending[tts_hash]
+
+        return tts_file
+
+    def evict(self, keep_hash):
+        ''' removes least recently used files until within the disk budget,
+            never removing keep_hash; lock must be held '''
+
+        total_bytes = sum(entry['size'] for entry in self.index.values())
+        if total_bytes <= self.max_bytes:
+            return
+
+        for tts_hash in sorted(self.index, key=lambda tts_hash: self.index[tts_hash]['used']):
+            if total_bytes <= self.max_bytes:
+                break
+            if tts_hash == keep_hash:
+                continue
+            total_bytes -= self.index[tts_hash]['size']
+            del self.index[tts_hash]
+            try:
+                os.remove(self.file_name(tts_hash))
+            except OSError:
+                pass
+
+    def schedule_save_locked(self):
+        ''' (re)start the index save timer, with the lock already held '''
+
+        if self.timer:
+            self.timer.cancel()
+        self.timer = Timer(TTS_INDEX_SAVE_DELAY, self.save_index)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def save_index(self):
+        ''' writes the index of cached speech to disk, called by the timer '''
+
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            try:
+                with open(f'{ self.index_file }.tmp', 'w') as fh_index:
+                    json.dump(self.index, fh_index)
+                os.replace(f'{ self.index_file }.tmp', self.index_file)
+            except OSError as index_err:
+                print(f'Warning, failed to write speech cache index, { index_err }')
+
+    def shutdown(self):
+        ''' abandons speech not yet generated and saves the index '''
+
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.save_index()
+
 
-    if ts_auth_type == 'plain':
-        ts_response = requests.get(ts_query, auth=(ts_user, ts_pass))
+##########################################################################################
+def join_audio_files(input_files, output_file):
+    ''' joins audio files of the same format end to end; MP3 is a sequence of
+        frames so is simply concatenated, WAV has its frames copied by wave '''
+
+    if output_file.endswith('.wav'):
+        with wave.open(output_file, 'wb') as wav_out:
+            for (file_num, input_file) in enumerate(input_files):
+                with wave.open(input_file, 'rb') as wav_in:
+                    if file_num == 0:
+                        wav_out.setparams(wav_in.getparams())
+                    elif wav_in.getparams()[:3] != wav_out.getparams()[:3]:
+                        raise wave.Error(f'{ input_file } is a different format')
+                    wav_out.writeframes(wav_in.readframes(wav_in.getnframes()))
     else:
-        ts_response = requests.get(ts_query, auth=HTTPDigestAuth(ts_user, ts_pass))
+        with open(output_file, 'wb') as fh_out:
+            for input_file in input_files:
+                with open(input_file, 'rb') as fh_in:
+                    shutil.copyfileobj(fh_in, fh_out)
 
-    print(f'<!-- get_tvh_chan_urls URL { ts_query } -->')
-    if ts_response.status_code != 200:
-        print('>Error code %d\n%s' % (ts_response.status_code, ts_response.content, ))
-        return {}
 
-    ts_json = ts_response.json()
-    if GLOBALS[G_DBG_LEVEL] > 1:
-        print(json.dumps(ts_json, sort_keys=True, indent=4, separators=(',', ': ')) )
+##########################################################################################
+def time_speech_segments():
+    ''' returns all the phrases needed to speak any time and date this year or next '''
+
+    this_year = datetime.date.today().year
+    return list(TTS_TIME_PHRASES) + \
+           [str(number) for number in range(60)] + \
+           list(calendar.month_name[1:]) + \
+           [str(this_year), str(this_year + 1)]
+
+
+##########################################################################################
+def chan_data_to_tts_file(chan_name):
+    ''' given the channel data, returns the name of a sound file which is the
+        channel name, or None; the speech cache generates it if required '''
+
+    global GLOBALS
+
+    return GLOBALS[G_TTS_CACHE].get(chan_name)
+
+
+##########################################################################################
+def tvh_chan_pages(content_hash):
+    ''' generator which pages through the TVH channel grid with start and limit,
+        parsing each page as it arrives so only one page is ever held in memory
+
+        content_hash is a hashlib object which is updated with each page
+        yields a list of (channel name, stream URL, channel number) tuples per page
+    '''
+
+    global GLOBALS
+
+    import requests
+
+    ts_client = get_tvh_client()
+    ts_url = GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_URL]
+    ts_chn_lim = int(GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_CHN_LIMIT])
 
     if TS_PAUTH in GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION]:
         ts_pauth = '&AUTH=%s' % (GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_PAUTH], )
     else:
         ts_pauth = ''
 
+    name_unknown = 0
+    chan_start = 0
+    while chan_start < ts_chn_lim:
+        page_limit = min(TS_PAGE_CHANS, ts_chn_lim - chan_start)
+        ts_response = ts_client.get(TS_URL_CHN, params={'start': chan_start, 'limit': page_limit})
 
-    chan_map = {}  #  channel-name =>stream-url
-    if 'entries' in ts_json:
-        # grab all channel info
-        name_unknown = 0
-        #number_unknown = -1
-        for entry in ts_json['entries']:
+        print(f'<!-- get_tvh_chan_urls URL { ts_response.url } -->')
+        if ts_response.status_code != 200:
+            print('>Error code %d\n%s' % (ts_response.status_code, ts_response.content, ))
+            raise requests.exceptions.HTTPError(f'channel grid status { ts_response.status_code }',
+                                                response=ts_response)
+
+        content_hash.update(ts_response.content)
+        ts_json = ts_response.json()
+        ts_entries = ts_json.get('entries', [])
+
+        page_chans = []
+        for entry in ts_entries:
             # start building a dict with channel name as key
             if 'name' in entry:
                 if 'name-not-set' in entry['name']:
@@ -492,17 +1155,279 @@ def get_tvh_chan_urls():
                 chan_name = 'unknown ' + str(name_unknown)
                 name_unknown += 1
 
-            chan_map[chan_name] = '%s/%s/%s?profile=%s%s' % \
-                                  (GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_URL],
-                                   TS_URL_STR,
-                                   entry['uuid'],
-                                   TS_PROFILE,
-                                   ts_pauth, )
+            chan_url = '%s/%s/%s?profile=%s%s' % (ts_url, TS_URL_STR, entry['uuid'],
+                                                  TS_PROFILE, ts_pauth, )
+            if GLOBALS[G_DBG_LEVEL] > 1:
+                print(f'Debug, channel { chan_name } : { chan_url }')
+            page_chans.append((chan_name, chan_url, entry.get('number', 0)))
+
+        if GLOBALS[G_DBG_LEVEL] > 0:
+            print(f'Debug, channel grid page at { chan_start } had { len(page_chans) } channels')
+
+        yield page_chans
+
+        # a short page, or having all the server says it has, is the end
+        chan_start += len(ts_entries)
+        if len(ts_entries) < page_limit or chan_start >= ts_json.get('total', ts_chn_lim):
+            break
+
+
+##########################################################################################
+def fetch_tvh_chan_map(first_page_callback=None):
+    ''' gets the channel listing a page at a time and generates an ordered dict,
+        calling first_page_callback with the channels and numbers of the first page
+        returns tuple (chan_map, chan_numbers, content_hash) where chan_map is a dict
+        with key = channel name, value = stream URL, and chan_numbers is a dict
+        with key = channel name, value = TVH channel number
+    '''
+
+    import requests
+
+    content_hash = hashlib.sha256()
+    chan_map = {}  #  channel-name =>stream-url
+    chan_numbers = {}
+    try:
+        for page_chans in tvh_chan_pages(content_hash):
+            for (chan_name, chan_url, chan_number) in page_chans:
+                chan_map[chan_name] = chan_url
+                if chan_number:
+                    chan_numbers[chan_name] = chan_number
+            if first_page_callback:
+                first_page_callback(dict(sorted(chan_map.items())), dict(chan_numbers))
+                first_page_callback = None
+    except requests.exceptions.HTTPError:
+        return ({}, {}, '')
+
+    return (dict(sorted(chan_map.items())), chan_numbers, content_hash.hexdigest())
+
+
+##########################################################################################
+def get_tvh_chan_urls():
+    ''' gets the channel listing and generates an ordered dict
+        returns dict: key = channel name, value = stream URL
+    '''
+
+    (chan_map, _chan_numbers, _content_hash) = fetch_tvh_chan_map()
+
+    return chan_map
+
+
+##########################################################################################
+def tvh_chan_cache_source():
+    ''' returns a string identifying the server and token the channel URLs were
+        built from, so a cache made with different settings is not used '''
+
+    global GLOBALS
+
+    return '%s %s' % (GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_URL],
+                      GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION].get(TS_PAUTH, ''), )
+
+
+##########################################################################################
+def load_tvh_chan_cache():
+    ''' reads the cached TVH channel map from the settings directory
+
+    returns a dict with the keys fetched, hash, channels and numbers, or an
+    empty dict if there's no usable cache
+    '''
+
+    cache_file = os.path.join(os.environ['HOME'], SETTINGS_DIR, TVH_CHAN_CACHE)
+    if not os.path.isfile(cache_file):
+        return {}
+
+    try:
+        with open(cache_file, 'r') as fh_cache:
+            cache = json.load(fh_cache)
+    except (OSError, ValueError) as cache_err:
+        print(f'Warning, channel cache { cache_file } unreadable, { cache_err }')
+        return {}
+
+    if not isinstance(cache, dict) or cache.get('source') != tvh_chan_cache_source():
+        return {}
+
+    if not cache.get('channels'):
+        return {}
+
+    return cache
+
+
+##########################################################################################
+def save_tvh_chan_cache(chan_map, chan_numbers, content_hash):
+    ''' writes the TVH channel map, numbers and content hash to the cache file,
+        via a temporary file so a crash never leaves a half written cache '''
+
+    cache_file = os.path.join(os.environ['HOME'], SETTINGS_DIR, TVH_CHAN_CACHE)
+    cache = {
+        'source': tvh_chan_cache_source(),
+        'fetched': time.time(),
+        'hash': content_hash,
+        'channels': chan_map,
+        'numbers': chan_numbers,
+    }
+
+    try:
+        with open(f'{ cache_file }.tmp', 'w') as fh_cache:
+            json.dump(cache, fh_cache)
+        os.replace(f'{ cache_file }.tmp', cache_file)
+    except OSError as cache_err:
+        print(f'Warning, failed to write channel cache { cache_file }, { cache_err }')
+
+    return cache
+
+
+##########################################################################################
+def tvh_chan_fetch(cache, first_page=False):
+    ''' fetches the channel map from the TVH server, and if it differs from the
+        cached one, hands the new map to the main loop
+
+        if first_page is True, the channels are also handed over as soon as the
+        first page has arrived, so they can be used while the rest arrive
+
+        returns tuple (cache, complete), the cache updated if the channels changed,
+        and complete True if the whole channel list arrived
+    '''
+
+    global GLOBALS
+
+    import requests
+
+    def first_page_handover(chan_map, chan_numbers):
+        ''' called with the first page '''
+        GLOBALS[G_TVH_CHAN_NUMBERS] = chan_numbers
+        post_command(CMD_TVH_UPDATE, chan_map)
+
+    try:
+        (chan_map, chan_numbers, content_hash) = \
+            fetch_tvh_chan_map(first_page_handover if first_page else None)
+    except requests.exceptions.RequestException as req_err:
+        print(f'Warning, couldn\'t get channels from TVH server, { req_err }')
+        return (cache, False)
+
+    # the server sent us exactly the same thing again
+    if content_hash and content_hash == cache.get('hash'):
+        save_tvh_chan_cache(cache['channels'], cache.get('numbers', {}), content_hash)
+        if GLOBALS[G_DBG_LEVEL]: print('Debug, TVH channel cache is up to date')
+        return (cache, True)
+
+    if not chan_map:
+        print('Warning, TVH server returned no channels, keeping current list')
+        return (cache, False)
 
-    if GLOBALS[G_DBG_LEVEL] > 0:
-        print(json.dumps(chan_map, sort_keys=True, indent=4, separators=(',', ': ')) )
+    if GLOBALS[G_DBG_LEVEL]: print(f'Debug, TVH channel list fetched, { len(chan_map) } channels')
+    GLOBALS[G_TVH_CHAN_NUMBERS] = chan_numbers
+    post_command(CMD_TVH_UPDATE, chan_map)
 
-    return dict(sorted(chan_map.items()))
+    return (save_tvh_chan_cache(chan_map, chan_numbers, content_hash), True)
+
+
+##########################################################################################
+def tvh_chan_fetch_thread(cache, first_page=False):
+    ''' checks the channel map with the TVH server in the background, first
+        straight away and then every TS_REFRESH minutes until shut down; if only
+        the first page arrived it tries again after TS_RETRY_SECS, refresh or not '''
+
+    global GLOBALS
+
+    refresh_secs = float(get_setting(TS_REFRESH)) * 60
+
+    (cache, complete) = tvh_chan_fetch(cache, first_page)
+    # without a cache, the channels in use are just the first page, if that, until
+    # a fetch completes
+    partial = first_page and not complete
+    while partial or refresh_secs > 0:
+        if partial:
+            print(f'Warning, not all the TVH channels arrived, trying again in { TS_RETRY_SECS }s')
+        if GLOBALS[G_SHUTDOWN].wait(TS_RETRY_SECS if partial else refresh_secs):
+            break
+        (cache, complete) = tvh_chan_fetch(cache)
+        partial = partial and not complete
+
+
+##########################################################################################
+def diff_chan_maps(old_map, new_map):
+    ''' compares two channel maps, returns tuple (added, removed, changed)
+        where added and changed are dicts of name => url, removed is a list of names '''
+
+    added = {name: url for (name, url) in new_map.items() if name not in old_map}
+    removed = [name for name in old_map if name not in new_map]
+    changed = {name: url for (name, url) in new_map.items()
+               if name in old_map and old_map[name] != url}
+
+    return (added, removed, changed)
+
+
+##########################################################################################
+def apply_chan_map_diff(chan_map, added, removed, changed):
+    ''' applies the differences from diff_chan_maps to chan_map in place,
+        keeping it sorted by channel name '''
+
+    for chan_name in removed:
+        del chan_map[chan_name]
+
+    chan_map.update(changed)
+
+    # new channels would otherwise be out of order at the end
+    if added:
+        chan_map.update(added)
+        sorted_items = sorted(chan_map.items())
+        chan_map.clear()
+        chan_map.update(sorted_items)
+
+
+##########################################################################################
+class ChannelIndex():
+    ''' index over the channel names of a mode for jumping straight to a channel:
+        by number in constant time, by the start of a name with a binary search
+        of the case-folded names, and failing those by the closest fuzzy match '''
+
+    def __init__(self, chan_names, chan_numbers=None):
+        self.chan_names = chan_names
+        folded = sorted((chan_name.casefold(), chan_num)
+                        for (chan_num, chan_name) in enumerate(chan_names))
+        self.folded_names = [folded_name for (folded_name, _chan_num) in folded]
+        self.folded_nums = [chan_num for (_folded_name, chan_num) in folded]
+
+        # TVH channels have numbers, for other lists the number is the position
+        if chan_numbers:
+            self.numbers = {str(chan_numbers[chan_name]): chan_num
+                            for (chan_num, chan_name) in enumerate(chan_names)
+                            if chan_name in chan_numbers}
+        else:
+            self.numbers = {str(chan_num + 1): chan_num for chan_num in range(len(chan_names))}
+
+    def by_number(self, text):
+        ''' returns the position of the channel with number text, or None '''
+
+        return self.numbers.get(text.strip())
+
+    def by_prefix(self, text):
+        ''' returns the position of the first channel whose name starts with
+            text, ignoring case, or None '''
+
+        folded_text = text.casefold()
+        pos = bisect.bisect_left(self.folded_names, folded_text)
+        if pos < len(self.folded_names) and self.folded_names[pos].startswith(folded_text):
+            return self.folded_nums[pos]
+        return None
+
+    def by_fuzzy(self, text):
+        ''' returns the position of the channel whose name is closest to text, or None '''
+
+        matches = difflib.get_close_matches(text.casefold(), self.folded_names, n=1,
+                                            cutoff=SEARCH_FUZZY_CUTOFF)
+        if matches:
+            return self.folded_nums[bisect.bisect_left(self.folded_names, matches[0])]
+        return None
+
+    def search(self, text):
+        ''' returns the position of the best match for text, which can be a
+            number, the start of a name or a misspelt name, or None '''
+
+        for search_func in (self.by_number, self.by_prefix, self.by_fuzzy):
+            chan_num = search_func(text)
+            if chan_num is not None:
+                return chan_num
+        return None
 
 
 ##########################################################################################
@@ -596,13 +1521,24 @@ def settings_editor(settings_file):
 
 ##########################################################################################
 def play_time():
-    ''' writes the time and date into temp file and calls Google TTS to speak it '''
+    ''' speaks the time and date, joining pre-rendered phrases and numbers from the
+        speech cache so only the first use needs the speech backend '''
+
+    global GLOBALS
 
     now = datetime.datetime.now()
-    the_time_is = now.strftime('the time is %M minutes past %H, on %b %d, %Y')
-    time_file = os.path.join(os.path.join(os.environ['HOME'], SETTINGS_DIR, 'time_file.mp3'))
-    text_to_speech_file(the_time_is, time_file)
-    play_file(time_file)
+    # the time is %M minutes past %H, on %B %d, %Y
+    the_time_is = [TTS_TIME_PHRASES[0], str(now.minute), TTS_TIME_PHRASES[1], str(now.hour),
+                   TTS_TIME_PHRASES[2], calendar.month_name[now.month], str(now.day),
+                   str(now.year), ]
+    time_file = GLOBALS[G_TTS_CACHE].get_joined(the_time_is)
+    if time_file:
+        try:
+            play_file(time_file)
+        finally:
+            os.remove(time_file)
+    else:
+        print('Warning, couldn\'t speak the time')
 
 
 ##########################################################################################
@@ -620,154 +1556,2034 @@ def play_file(audio_file_name):
 
 
 ##########################################################################################
-# play_channel
-def play_channel(stream_url):
-    ''' starts playing stream in a sub process
-        if it sees STOP_PLAYBACK then it kills the player '''
+class StreamFeed():
+    ''' reads a stream from its URL in a thread, keeping the most recent chunks
+        in memory so a player can be given data without waiting to connect.
+        Chunks are numbered in sequence so readers can follow the stream. A feed
+        can be shared, it's only closed when the last user closes it. '''
+
+    def __init__(self, stream_url, max_bytes=FEED_BUFFER):
+        self.url = stream_url
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.first_seq = 0          # sequence number of chunks[0]
+        self.buffered_bytes = 0
+        self.closed = False
+        self.users = 1              # closing it is left to the last user
+        self.cond = Condition()
+        self.response = None
+        self.content_type = ''
+        self.connected = Event()    # set once the server has answered, or it failed
+        self.thread = Thread(target=self.reader_thread, daemon=True)
+
+    def start(self):
+        ''' starts reading the stream, returns self '''
+
+        self.thread.start()
+        return self
+
+    def reader_thread(self):
+        ''' reads the stream into the buffer until closed or the stream ends '''
+
+        import requests
+        import urllib3
+
+        timeout = (float(get_setting(TS_TIMEOUT_CONNECT)), float(get_setting(TS_TIMEOUT_READ)))
+        try:
+            self.response = requests.get(self.url, stream=True, timeout=timeout)
+            if self.closed:
+                return
+            self.content_type = self.response.headers.get('Content-Type', '')
+            self.connected.set()
+            if self.response.status_code != 200:
+                print(f'Warning, stream { self.url } status { self.response.status_code }')
+            elif hasattr(self.response.raw, 'read1'):
+                # take whatever has arrived, rather than waiting for a whole chunk,
+                # so a player or relay listener gets it as soon as the server sends it
+                while not self.closed:
+                    chunk = self.response.raw.read1(FEED_CHUNK, decode_content=True)
+                    if not chunk:
+                        break
+                    self.add_chunk(chunk)
+            else:
+                # urllib3 before 2.0 can only wait for a whole chunk
+                for chunk in self.response.iter_content(chunk_size=FEED_CHUNK):
+                    if self.closed:
+                        break
+                    self.add_chunk(chunk)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError,
+                AttributeError, ValueError) as feed_err:
+            # shutting down the socket under the reader also ends up here
+            if not self.closed:
+                print(f'Warning, stream { self.url } failed, { feed_err }')
+        finally:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+                # under the lock, so close() never shuts down a reused descriptor
+                if self.response is not None:
+                    self.response.close()
+            self.connected.set()
+
+    def add_chunk(self, chunk):
+        ''' appends a chunk, dropping the oldest when over the buffer size '''
+
+        with self.cond:
+            self.chunks.append(chunk)
+            self.buffered_bytes += len(chunk)
+            while self.buffered_bytes > self.max_bytes and len(self.chunks) > 1:
+                self.buffered_bytes -= len(self.chunks.popleft())
+                self.first_seq += 1
+            self.cond.notify_all()
+
+    def oldest_seq(self):
+        ''' returns the sequence number of the oldest chunk still buffered '''
+
+        with self.cond:
+            return self.first_seq
+
+    def live_offset(self, max_bytes):
+        ''' returns the tuple (sequence number of the oldest chunk, bytes from it to the
+            chunk at recent_seq(max_bytes)), so a copy of everything buffered knows
+            where live is '''
+
+        with self.cond:
+            live_chunks = self.recent_seq(max_bytes) - self.first_seq
+            return (self.first_seq, sum(len(self.chunks[chunk_num])
+                                        for chunk_num in range(live_chunks)))
+
+    def recent_seq(self, max_bytes):
+        ''' returns the sequence number of the oldest chunk within max_bytes of
+            the newest, for a reader joining a live stream '''
+
+        with self.cond:
+            seq = self.first_seq + len(self.chunks)
+            recent_bytes = 0
+            for chunk in reversed(self.chunks):
+                recent_bytes += len(chunk)
+                if recent_bytes > max_bytes:
+                    break
+                seq -= 1
+            return seq
+
+    def chunks_from(self, seq, stopped=None):
+        ''' generator yielding chunks from sequence number seq onwards, waiting for
+            new ones, until the feed is closed or the stopped Event is set; skips
+            forward over chunks which have already been dropped from the buffer '''
+
+        while True:
+            with self.cond:
+                while seq >= self.first_seq + len(self.chunks) and not self.closed and \
+                      not (stopped and stopped.is_set()):
+                    self.cond.wait()
+                if seq >= self.first_seq + len(self.chunks) or (stopped and stopped.is_set()):
+                    return
+                seq = max(seq, self.first_seq)
+                chunk = self.chunks[seq - self.first_seq]
+            yield chunk
+            seq += 1
+
+    def wake(self):
+        ''' wakes readers so they notice they've been stopped '''
+
+        with self.cond:
+            self.cond.notify_all()
+
+    def is_alive(self):
+        ''' returns True if the stream is still being read '''
+
+        return not self.closed
+
+    def share(self):
+        ''' another user of the feed, who must close it when done, returns self '''
+
+        with self.cond:
+            self.users += 1
+        return self
+
+    def close(self):
+        ''' lets go of the feed, the last user to close it stops reading the stream
+            and wakes up any readers; it returns straight away, the reader thread
+            closes the response '''
+
+        with self.cond:
+            self.users -= 1
+            if self.users > 0:
+                return
+            self.closed = True
+            self.cond.notify_all()
+
+            # closing the response would wait for a read from a stalled stream to
+            # time out, shutting down the socket ends the read at once
+            if self.response is not None:
+                try:
+                    with socket.socket(fileno=os.dup(self.response.raw.fileno())) as feed_sock:
+                        feed_sock.shutdown(socket.SHUT_RDWR)
+                except (OSError, ValueError):
+                    pass
 
-    global GLOBALS
 
-    url = stream_url
+##########################################################################################
+class PreBuffer():
+    ''' opens the stream of the channel the user has settled on, after they have
+        been idle on it for a while, so playing it starts from buffered data rather
+        than waiting for the server to tune and the player to buffer '''
+
+    def __init__(self, idle_secs):
+        self.idle_secs = idle_secs
+        self.lock = Lock()
+        self.wanted_url = ''
+        self.feed = None
+        self.timer = None
+
+    def select(self, stream_url):
+        ''' the user is now on the channel with stream_url, (re)start the idle timer '''
+
+        with self.lock:
+            if stream_url == self.wanted_url:
+                return
+            self.cancel_locked()
+            self.wanted_url = stream_url
+            self.timer = Timer(self.idle_secs, self.open, args=(stream_url, ))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def open(self, stream_url):
+        ''' called by the timer, opens the stream if the user is still on the channel '''
+
+        with self.lock:
+            if stream_url != self.wanted_url or self.feed:
+                return
+            if GLOBALS[G_DBG_LEVEL]: print(f'Debug, pre-buffering { stream_url }')
+            self.feed = StreamFeed(stream_url).start()
+            # don't hold a stream open for ever if the user doesn't play it
+            self.timer = Timer(PREBUFFER_MAX_SECS, self.cancel)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def take(self, stream_url):
+        ''' returns the pre-buffered feed for stream_url, or None, for the caller to
+            play from and close '''
+
+        with self.lock:
+            feed = None
+            if self.feed and self.feed.url == stream_url and self.feed.is_alive():
+                feed = self.feed
+                self.feed = None
+            self.cancel_locked()
+            return feed
+
+    def cancel(self):
+        ''' forgets the wanted channel and closes any pre-buffered stream '''
+
+        with self.lock:
+            self.cancel_locked()
+
+    def cancel_locked(self):
+        ''' cancel, with the lock already held '''
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.feed:
+            self.feed.close()
+            self.feed = None
+        self.wanted_url = ''
 
-    play_cmd = GLOBALS[G_MY_SETTINGS].get(SETTINGS_SECTION, PLAYER_COMMAND)
-    play_cmd_array = play_cmd.split()
-    play_cmd_array.append(url)
-    print('Debug, play command is "%s"' % ('" "'.join(play_cmd_array), ))
 
-    player_proc = subprocess.Popen(play_cmd_array, shell=False)
-    GLOBALS[G_PLAYER_PID] = player_proc.pid
-    if GLOBALS[G_DBG_LEVEL]: print('Debug, player pid %d' % (player_proc.pid, ))
+##########################################################################################
+def feed_player(chunks, player_stdin):
+    ''' copies the stream chunks, from a feed or a timeshift buffer, to the player
+        until they run out or the player goes away '''
+
+    try:
+        for chunk in chunks:
+            # the pipe is buffered, each chunk goes to the player as it arrives
+            player_stdin.write(chunk)
+            player_stdin.flush()
+    except (BrokenPipeError, OSError, ValueError):
+        pass
+    finally:
+        try:
+            player_stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
 
-    player_active = True
 
-    # we check every second if the player is running or told to kill it
-    while player_active:
+##########################################################################################
+class TimeshiftBuffer():
+    ''' a ring buffer of the most recent bytes of a feed, in a memory mapped
+        temporary file of fixed size, so memory use is bounded and the kernel can
+        page it out. Positions are counts of bytes since the start of the stream,
+        the ring holds the last max_bytes of them. The feed keeps being read while
+        the player is paused, and a player can be started from any position. '''
+
+    def __init__(self, feed, chan_name, max_bytes):
+        self.feed = feed
+        self.chan_name = chan_name
+        self.max_bytes = max_bytes
+        self.ring_file = tempfile.TemporaryFile(prefix='tvh_radio_timeshift')
+        self.ring_file.truncate(max_bytes)
+        self.ring = mmap.mmap(self.ring_file.fileno(), max_bytes)
+        self.cond = Condition()
+        self.write_pos = 0          # bytes written to the ring since the start
+        self.play_pos = 0           # bytes given to the player so far
+        self.pipe_bytes = PIPE_DEFAULT_BYTES  # size of the pipe to the player
+        self.paused_pos = None      # where to resume from when paused
+        self.backlog_bytes = 0      # bytes the feed already had, not live
+        self.started = time.monotonic()
+        self.closed = False
+        self.fill_stopped = Event()  # the feed may be shared with a recording
+        # the ring starts with all the feed has buffered, a player starts near live
+        (self.start_seq, self.live_pos) = feed.live_offset(FEED_PLAYER_BACKLOG)
+        self.thread = Thread(target=self.fill_thread, daemon=True)
+
+    def start(self):
+        ''' starts copying the feed into the ring, returns self '''
+
+        self.thread.start()
+        return self
+
+    def fill_thread(self):
+        ''' copies the feed into the ring, starting with what it has buffered '''
+
+        backlog_chunks = self.feed.recent_seq(0) - self.start_seq
         try:
-            # poll for playback process to end
-            player_proc.wait(timeout=1)
-            # only gets here if playback process ended
-            #print('Debug, player finished')
-            player_active = False
-            GLOBALS[G_STOP_PLAYBACK] = False
-            GLOBALS[G_PLAYER_PID] = 0
-
-        # if the player is still running this exception is called
-        except subprocess.TimeoutExpired:
-            pass
-            #print('Debug, player still running')
+            for chunk in self.feed.chunks_from(self.start_seq, self.fill_stopped):
+                if backlog_chunks > 0:
+                    backlog_chunks -= 1
+                    self.backlog_bytes += len(chunk)
+                self.write(chunk)
+        finally:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+
+    def write(self, data):
+        ''' appends data to the ring, wrapping round over the oldest '''
+
+        with self.cond:
+            if self.closed:
+                return
+            offset = self.write_pos % self.max_bytes
+            first_part = min(len(data), self.max_bytes - offset)
+            self.ring[offset:offset + first_part] = data[:first_part]
+            if first_part < len(data):
+                self.ring[0:len(data) - first_part] = data[first_part:]
+            self.write_pos += len(data)
+            self.cond.notify_all()
+
+    def oldest_pos(self):
+        ''' returns the position of the oldest byte still in the ring '''
+
+        with self.cond:
+            return max(self.write_pos - self.max_bytes, 0)
+
+    def bytes_per_sec(self):
+        ''' returns the rate the stream arrives at, to turn seconds into bytes '''
+
+        with self.cond:
+            live_secs = time.monotonic() - self.started
+            live_bytes = self.write_pos - self.backlog_bytes
+        if live_secs < 1 or live_bytes <= 0:
+            return TIMESHIFT_DEFAULT_RATE
+        return live_bytes / live_secs
+
+    def secs_behind(self, pos):
+        ''' returns how many seconds pos is behind live '''
+
+        with self.cond:
+            behind_bytes = self.write_pos - pos
+        return behind_bytes / self.bytes_per_sec()
+
+    def heard_pos(self):
+        ''' returns an estimate of the position the listener has heard up to, the
+            bytes given to the player less those still in the pipe and in the
+            player's own buffer, which are lost when the player is stopped '''
+
+        unplayed = self.pipe_bytes + int(self.bytes_per_sec() * TIMESHIFT_PLAYER_SECS)
+        return max(self.play_pos - unplayed, self.oldest_pos())
+
+    def chunks_from(self, pos, stopped):
+        ''' generator yielding bytes from position pos onwards, waiting for more,
+            until the ring is closed or the stopped Event is set; a reader left
+            behind by the ring wrapping round skips forward to the oldest byte '''
+
+        while True:
+            with self.cond:
+                while pos >= self.write_pos and not self.closed and not stopped.is_set():
+                    self.cond.wait()
+                if pos >= self.write_pos or stopped.is_set():
+                    return
+                pos = max(pos, self.write_pos - self.max_bytes)
+                offset = pos % self.max_bytes
+                chunk_len = min(self.write_pos - pos, FEED_CHUNK, self.max_bytes - offset)
+                chunk = self.ring[offset:offset + chunk_len]
+            yield chunk
+            pos += chunk_len
+            self.play_pos = pos
+
+    def wake(self):
+        ''' wakes readers so they notice they've been stopped '''
+
+        with self.cond:
+            self.cond.notify_all()
+
+    def close(self):
+        ''' stops reading the feed and frees the ring '''
+
+        self.fill_stopped.set()
+        self.feed.close()
+        self.feed.wake()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.ring.close()
+        self.ring_file.close()
+
 
-        # kill the player on demand
-        if GLOBALS[G_STOP_PLAYBACK]:
-            #print('Debug, killing player process')
-            player_proc.kill()
+##########################################################################################
+class Recorder():
+    ''' writes a feed to files in the recordings directory from a thread, as it
+        arrives and without re-encoding, starting a new file when one reaches the
+        time or size limit and deleting the oldest beyond the number to keep.
+        The recorder closes the feed at the end, so it's given a new or shared one. '''
+
+    def __init__(self, feed, chan_name):
+        self.feed = feed
+        self.chan_name = chan_name
+        self.stopped = Event()
+        self.file_name = ''
+        self.file_names = []
+        self.time_stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.part_num = 0
+        self.split_secs = float(get_setting(RECORD_SPLIT_MINS)) * 60
+        self.split_bytes = int(float(get_setting(RECORD_SPLIT_MB)) * 1024 * 1024)
+        self.keep_files = int(get_setting(RECORD_KEEP))
+        self.record_dir = os.path.join(os.environ['HOME'], SETTINGS_DIR, RECORDINGS_DIR)
+        self.thread = Thread(target=self.record_thread, daemon=True)
+
+    def start(self):
+        ''' starts recording, returns self '''
+
+        os.makedirs(self.record_dir, exist_ok=True)
+        self.thread.start()
+        return self
+
+    def new_file(self):
+        ''' returns a newly opened file for the next part of the recording '''
+
+        self.feed.connected.wait(float(get_setting(TS_TIMEOUT_CONNECT)))
+        content_type = self.feed.content_type.split(';')[0].strip().lower()
+        extension = RECORD_EXTENSIONS.get(content_type, 'bin')
+        safe_name = re.sub(r'[^\w.-]+', '_', self.chan_name).strip('_') or 'recording'
+        self.part_num += 1
+        self.file_name = os.path.join(self.record_dir, f'{ safe_name }_{ self.time_stamp }_'
+                                                       f'{ self.part_num:03d}.{ extension }')
+        self.file_names.append(self.file_name)
+        print(f'Recording to { self.file_name }')
+
+        while self.keep_files > 0 and len(self.file_names) > self.keep_files:
+            try:
+                os.remove(self.file_names.pop(0))
+            except OSError:
+                pass
+
+        return open(self.file_name, 'wb', buffering=RECORD_BUFFER)
+
+    def record_thread(self):
+        ''' writes the feed from now on until stopped or the feed ends '''
+
+        fh_record = None
+        try:
+            for chunk in self.feed.chunks_from(self.feed.recent_seq(0), self.stopped):
+                if fh_record is None or \
+                   (self.split_secs > 0 and time.monotonic() - file_started >= self.split_secs) or \
+                   (self.split_bytes > 0 and file_bytes + len(chunk) > self.split_bytes):
+                    if fh_record:
+                        fh_record.close()
+                    fh_record = self.new_file()
+                    file_started = time.monotonic()
+                    file_bytes = 0
+                fh_record.write(chunk)
+                file_bytes += len(chunk)
+        except OSError as record_err:
+            print(f'Error, recording to { self.file_name } failed, { record_err }')
+        finally:
+            if fh_record:
+                fh_record.close()
+            self.feed.close()
+            print(f'Recording of { self.chan_name } finished')
+            if GLOBALS[G_RECORDER] is self:
+                GLOBALS[G_RECORDER] = None
+            publish_status()
+
+    def stop(self):
+        ''' asks the recording to finish, returns straight away '''
+
+        self.stopped.set()
+        self.feed.wake()
 
-    print('play_channel exiting')
-    GLOBALS[G_CHAN_NAME_PLAYING] = ''
 
 ##########################################################################################
-# SIGINT/ctrl-c handler
-def sigint_handler(_signal_number, _frame):
-    ''' called when signal 2 or CTRL-C hits process, simply flags request to quit '''
+class PlayerSupervisor():
+    ''' supervises a player process, waking the moment it exits or is asked to stop
+        rather than polling; a stop terminates the player, and kills it if it's
+        still running PLAYER_KILL_TIMEOUT seconds later '''
+
+    def __init__(self, requested=None):
+        self.proc = None
+        self.requested = requested or time.monotonic()    # when play was asked for
+        self.stop_requested = Event()
+        self.finished = Event()
+        self.lock = Lock()          # the pipe is only written while still open
+        (self.wake_read, self.wake_write) = os.pipe()
+
+    def stop(self):
+        ''' asks for the player to be stopped, returns straight away '''
 
-    global GLOBALS
+        global GLOBALS
 
-    print('\nCTRL-C QUIT')
-    GLOBALS[G_QUIT_FLAG] = True
-    GLOBALS[G_EVENT].set()
+        GLOBALS[G_STOP_PLAYBACK] = True
+        publish_status()
+        self.stop_requested.set()
+        with self.lock:
+            if not self.finished.is_set():
+                os.write(self.wake_write, b'.')
+
+    def wait(self, timeout=None):
+        ''' waits for the player to have finished, returns False on timeout '''
+
+        return self.finished.wait(timeout)
+
+    def close(self):
+        ''' closes the wake pipe and marks the player finished, whether or not it
+            ever started, so nobody waits for it for ever '''
+
+        with self.lock:
+            if not self.finished.is_set():
+                os.close(self.wake_read)
+                os.close(self.wake_write)
+                self.finished.set()
+
+    def exit_notifier(self):
+        ''' returns a file descriptor which becomes readable when the player exits,
+            a pidfd where the kernel has them, otherwise a pipe written by a thread '''
+
+        if hasattr(os, 'pidfd_open'):
+            try:
+                return os.pidfd_open(self.proc.pid)
+            except OSError:
+                pass
+
+        (exit_read, exit_write) = os.pipe()
+        def exit_waiter():
+            ''' waits for the player and then wakes the supervisor '''
+            self.proc.wait()
+            try:
+                os.write(exit_write, b'.')
+            except OSError:
+                pass    # the supervisor has already gone
+            finally:
+                os.close(exit_write)
+        Thread(target=exit_waiter, daemon=True).start()
+        return exit_read
+
+    def supervise(self, proc):
+        ''' waits for the player process to exit, dealing with stop requests '''
+
+        self.proc = proc
+        exit_fd = self.exit_notifier()
+        kill_time = None
+        time_started = time.monotonic()
+
+        try:
+            while self.proc.poll() is None:
+                if self.stop_requested.is_set() and kill_time is None:
+                    if GLOBALS[G_DBG_LEVEL]: print('Debug, terminating player')
+                    self.proc.terminate()
+                    kill_time = time.monotonic() + PLAYER_KILL_TIMEOUT
+                elif kill_time is not None and time.monotonic() >= kill_time:
+                    print('Warning, player didn\'t terminate, killing it')
+                    self.proc.kill()
+                    self.proc.wait()
+                    break
+
+                timeout = None if kill_time is None else max(kill_time - time.monotonic(), 0)
+                readable, _o, _e = select.select([exit_fd, self.wake_read], [], [], timeout)
+                if self.wake_read in readable:
+                    os.read(self.wake_read, 64)
+        finally:
+            GLOBALS[G_METRICS].player_run.observe(time.monotonic() - time_started)
+            if self.stop_requested.is_set():
+                GLOBALS[G_METRICS].player_exits.inc(reason='stopped')
+            else:
+                print(f'Warning, player exited unexpectedly with status { self.proc.returncode }')
+                GLOBALS[G_METRICS].player_exits.inc(reason='unexpected')
+            os.close(exit_fd)
+            self.close()
 
 
 ##########################################################################################
-def keyboard_listen_thread():
-    ''' keyboard listening thread, sets raw input and uses sockets to
-        get single key strokes without waiting, triggering an event. '''
+def shrink_pipe(pipe_file, pipe_bytes):
+    ''' asks for the pipe to hold no more than pipe_bytes, so less is lost when the
+        player reading it is stopped, returns the size it ends up as '''
 
-    global GLOBALS
+    try:
+        fcntl.fcntl(pipe_file.fileno(), fcntl.F_SETPIPE_SZ, pipe_bytes)
+        return fcntl.fcntl(pipe_file.fileno(), fcntl.F_GETPIPE_SZ)
+    except (AttributeError, OSError):
+        # not Linux, or a Python without the pipe size calls
+        return PIPE_DEFAULT_BYTES
 
-    # set term to raw, so doesn't wait for return
+
+##########################################################################################
+def player_stdin_arg(player_path):
+    ''' returns the argument which makes the player read standard input, for when
+        the setting is left empty, omxplayer wants "pipe:0" and most others "-" '''
+
+    if 'omxplayer' in os.path.basename(player_path):
+        return 'pipe:0'
+    return '-'
+
+
+##########################################################################################
+# play_channel
+def play_channel(stream_url, feed=None, supervisor=None, timeshift=None, start_pos=0):
+    ''' starts playing stream in a sub process, from the feed if there is one or
+        from start_pos in the timeshift buffer, and waits for it to finish; the
+        supervisor is told to stop it. The timeshift buffer outlives the player '''
+
+    global GLOBALS
+
+    url = stream_url
+    if supervisor is None:
+        supervisor = PlayerSupervisor()
+
+    play_cmd = GLOBALS[G_MY_SETTINGS].get(SETTINGS_SECTION, PLAYER_COMMAND)
+    play_cmd_array = play_cmd.split()
+    if feed or timeshift:
+        play_cmd_array.append(get_setting(PLAYER_STDIN) or player_stdin_arg(play_cmd_array[0]))
+    else:
+        play_cmd_array.append(url)
+    print('Debug, play command is "%s"' % ('" "'.join(play_cmd_array), ))
+
+    reader_stopped = Event()
+    feed_thread = None
+    try:
+        if timeshift:
+            player_proc = subprocess.Popen(play_cmd_array, shell=False, stdin=subprocess.PIPE)
+            timeshift.pipe_bytes = shrink_pipe(player_proc.stdin, TIMESHIFT_PIPE_BYTES)
+            feed_thread = Thread(target=feed_player,
+                                 args=(timeshift.chunks_from(start_pos, reader_stopped),
+                                       player_proc.stdin, ))
+            feed_thread.start()
+        elif feed:
+            player_proc = subprocess.Popen(play_cmd_array, shell=False, stdin=subprocess.PIPE)
+            feed_thread = Thread(target=feed_player,
+                                 args=(feed.chunks_from(feed.recent_seq(FEED_PLAYER_BACKLOG)),
+                                       player_proc.stdin, ))
+            feed_thread.start()
+        else:
+            player_proc = subprocess.Popen(play_cmd_array, shell=False)
+    except (OSError, subprocess.SubprocessError) as player_err:
+        print(f'Error, couldn\'t start the player, { player_err }')
+        player_proc = None
+
+    try:
+        if player_proc:
+            GLOBALS[G_PLAYER_PID] = player_proc.pid
+            GLOBALS[G_METRICS].player_spawn.observe(time.monotonic() - supervisor.requested)
+            if GLOBALS[G_DBG_LEVEL]: print('Debug, player pid %d' % (player_proc.pid, ))
+
+            # the feed is shared with anyone listening through the relay
+            GLOBALS[G_PLAYING_FEED] = timeshift.feed if timeshift else feed
+            publish_status()
+
+            supervisor.supervise(player_proc)
+    finally:
+        # the supervisor is finished even if the player never started
+        supervisor.close()
+
+        GLOBALS[G_PLAYING_FEED] = None
+        if timeshift:
+            reader_stopped.set()
+            timeshift.wake()
+        elif feed:
+            feed.close()
+        if feed_thread:
+            feed_thread.join()
+
+        print('play_channel exiting')
+        GLOBALS[G_STOP_PLAYBACK] = False
+        GLOBALS[G_PLAYER_PID] = 0
+        GLOBALS[G_CHAN_NAME_PLAYING] = ''
+        if GLOBALS[G_PLAYER] is supervisor:
+            GLOBALS[G_PLAYER] = None
+        publish_status()
+
+
+##########################################################################################
+def stop_playback(threads, keep_timeshift=False):
+    ''' asks the player to stop, waits until it has, and tidies up its thread;
+        the timeshift buffer is closed too, unless pausing or rewinding '''
+
+    global GLOBALS
+
+    player = GLOBALS[G_PLAYER]
+    if player:
+        player.stop()
+        player.wait()
+
+    if 'PB' in threads:
+        threads['PB'].join()
+        del threads['PB']
+
+    if GLOBALS[G_TIMESHIFT] and not keep_timeshift:
+        GLOBALS[G_TIMESHIFT].close()
+        GLOBALS[G_TIMESHIFT] = None
+        publish_status()
+
+
+##########################################################################################
+def start_player(threads, stream_url, feed=None, timeshift=None, start_pos=0, requested=None):
+    ''' starts play_channel in a thread with a new supervisor; requested is when
+        the command to play was posted '''
+
+    global GLOBALS
+
+    GLOBALS[G_PLAYER] = PlayerSupervisor(requested)
+    threads['PB'] = Thread(target=play_channel,
+                           args=(stream_url, feed, GLOBALS[G_PLAYER], timeshift, start_pos, ))
+    threads['PB'].start()
+
+
+##########################################################################################
+class Command():
+    ''' a command for the main loop, from the keyboard, the web or a background
+        thread; whoever posted it can wait for the main loop to act on it and
+        collect the result '''
+
+    def __init__(self, key, arg=None):
+        self.key = key
+        self.arg = arg
+        self.posted = time.monotonic()
+        self.merged = []        # commands coalesced into this one
+        self.result = None
+        self.done = Event()
+
+    def finish(self, result=''):
+        ''' called by the main loop when the command has been acted on '''
+
+        self.result = result
+        self.done.set()
+        for command in self.merged:
+            command.finish(result)
+
+    def wait(self, timeout=None):
+        ''' waits for the main loop to finish the command, returns the result
+            or None if it timed out '''
+
+        self.done.wait(timeout)
+        return self.result
+
+
+##########################################################################################
+class ShutdownEvent(Event):
+    ''' an Event which also makes wake_fd readable when it's set, so threads waiting
+        in select() for a file are woken at shutdown without having to poll '''
+
+    def __init__(self):
+        super().__init__()
+        (self.wake_fd, self.wake_write_fd) = os.pipe()
+
+    def set(self):
+        ''' sets the event and wakes anything selecting on wake_fd '''
+
+        super().set()
+        wake_write_fd = self.wake_write_fd
+        if wake_write_fd is not None:
+            os.write(wake_write_fd, b'\0')
+
+    def close(self):
+        ''' closes the pipe once nothing is selecting on it, can be called again '''
+
+        (wake_fd, wake_write_fd) = (self.wake_fd, self.wake_write_fd)
+        (self.wake_fd, self.wake_write_fd) = (None, None)
+        for pipe_fd in (wake_fd, wake_write_fd):
+            if pipe_fd is not None:
+                os.close(pipe_fd)
+
+
+##########################################################################################
+def post_command(key, arg=None):
+    ''' queues a command for the main loop, returns the Command to wait on;
+        safe to call from any thread and from signal handlers '''
+
+    global GLOBALS
+
+    command = Command(key, arg)
+    GLOBALS[G_COMMANDS].put(command)
+    return command
+
+
+##########################################################################################
+def get_commands():
+    ''' waits for a command to be posted, then returns a list of it and any others
+        queued behind it, with runs of up and down merged into one move '''
+
+    global GLOBALS
+
+    commands = [GLOBALS[G_COMMANDS].get()]
+    while True:
+        try:
+            commands.append(GLOBALS[G_COMMANDS].get_nowait())
+        except queue.Empty:
+            break
+
+    coalesced = []
+    for command in commands:
+        if command.key in ('u', 'd'):
+            step = 1 if command.key == 'u' else -1
+            if coalesced and coalesced[-1].key == CMD_MOVE:
+                coalesced[-1].arg += step
+                coalesced[-1].merged.append(command)
+            else:
+                move = Command(CMD_MOVE, step)
+                move.posted = command.posted
+                move.merged.append(command)
+                coalesced.append(move)
+        else:
+            coalesced.append(command)
+
+    return coalesced
+
+
+##########################################################################################
+# SIGINT/ctrl-c handler
+def sigint_handler(_signal_number, _frame):
+    ''' called when signal 2 or CTRL-C hits process, starts quitting straight away
+        and posts a request to quit to wake the main loop; the default handler is
+        put back, so a second CTRL-C stops the process if quitting gets stuck '''
+
+    global GLOBALS
+
+    print('\nCTRL-C QUIT')
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    GLOBALS[G_QUIT_FLAG] = 1
+    GLOBALS[G_SHUTDOWN].set()
+    post_command('q')
+
+
+##########################################################################################
+def sigterm_handler(_signal_number, _frame):
+    ''' called when signal 15 hits the process, as when systemd stops the radio,
+        posts a request to quit so it's stopped cleanly '''
+
+    print('\nSIGTERM QUIT')
+    post_command('q')
+
+
+##########################################################################################
+def sigusr1_handler(_signal_number, _frame):
+    ''' called on SIGUSR1 when profiling, posts a request to write the profile so far '''
+
+    post_command(CMD_PROFILE)
+
+
+##########################################################################################
+def keyboard_listen_thread():
+    ''' keyboard listening thread, sets raw input and uses sockets to
+        get single key strokes without waiting, posting them as commands. '''
+
+    global GLOBALS
+
+    # run in the background or with input redirected, there are no keys to read
+    if not sys.stdin.isatty():
+        print('Warning, standard input is not a terminal, keyboard control is off')
+        return
+
+    # set term to raw, so doesn't wait for return
     old_settings = termios.tcgetattr(sys.stdin)
     tty.setcbreak(sys.stdin.fileno())
 
     while GLOBALS[G_QUIT_FLAG] == 0:
-        # a bit ugly, but use a timeout just to occasionally check QUIT_FLAG
-        readable_sockets, _o, _e = select.select([sys.stdin], [], [], KEYBOARD_POLL_TIMEOUT)
+        # the shutdown pipe wakes this up at quit, so there's no need to poll
+        readable_sockets, _o, _e = select.select([sys.stdin, GLOBALS[G_SHUTDOWN].wake_fd], [], [])
+        if GLOBALS[G_SHUTDOWN].is_set():
+            break
         if readable_sockets:
-            GLOBALS[G_KEY_STROKE] = sys.stdin.read(1)
-            GLOBALS[G_EVENT].set()
+            key_stroke = sys.stdin.read(1)
+            if key_stroke == SEARCH_KEY:
+                search_text = keyboard_read_search()
+                if search_text:
+                    post_command(CMD_SEARCH, search_text)
+            else:
+                post_command(key_stroke)
 
     # set term back to cooked
     termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_settings)
 
 
 ##########################################################################################
-def save_favourites(list_data):
-    ''' saves the current favourites to a file '''
+def keyboard_read_search():
+    ''' reads the text to search for a key at a time, echoing it, until enter;
+        returns the text, or '' if escape was pressed '''
+
+    global GLOBALS
+
+    search_text = ''
+    print('Search: ', end='', flush=True)
+    while not GLOBALS[G_QUIT_FLAG]:
+        select.select([sys.stdin, GLOBALS[G_SHUTDOWN].wake_fd], [], [])
+        if GLOBALS[G_SHUTDOWN].is_set():
+            break
+        key_stroke = sys.stdin.read(1)
+        if key_stroke in ('\n', '\r'):
+            break
+        if key_stroke == '\x1b':
+            search_text = ''
+            break
+        if key_stroke in ('\x7f', '\b'):
+            if search_text:
+                search_text = search_text[:-1]
+                print('\b \b', end='', flush=True)
+        elif key_stroke.isprintable():
+            search_text += key_stroke
+            print(key_stroke, end='', flush=True)
+    print('')
+
+    return search_text
 
-    write_list_file(FAVOURITES_HDR,
-                    os.path.join(os.environ['HOME'], SETTINGS_DIR, FAVOURITES_LIST),
-                    list_data)
 
 ##########################################################################################
-class MyHTTPRequestHandler(SimpleHTTPRequestHandler):
-    ''' minimal http request handler for remote control '''
+def control_reply(request_text):
+    ''' acts on a request line from the control socket, returns the reply as a dict
+
+        a request is a key such as p or u, / followed by text to search for,
+        or status; or the same as a JSON object such as {"command": "p"},
+        {"command": "search", "arg": "radio 4"} or {"command": "status",
+        "since": 12, "wait": 30}, which waits for the status to change from
+        version 12 like the web long-poll '''
 
     global GLOBALS
 
+    if request_text.startswith('{'):
+        try:
+            request = json.loads(request_text)
+        except ValueError as json_err:
+            return {'ok': False, 'error': f'bad JSON, { json_err }'}
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'the request must be a JSON object'}
+    elif request_text.startswith(SEARCH_KEY):
+        request = {'command': CMD_SEARCH, 'arg': request_text[len(SEARCH_KEY):].strip()}
+    else:
+        request = {'command': request_text}
+
+    command_key = request.get('command')
+    if command_key == 'status':
+        try:
+            since = int(request.get('since', -1))
+            wait_secs = min(float(request.get('wait', 0)), WEB_LONG_POLL_MAX)
+        except (TypeError, ValueError):
+            return {'ok': False, 'error': 'since and wait must be numbers'}
+        if wait_secs > 0:
+            (version, state) = GLOBALS[G_STATUS].wait_change(since, wait_secs)
+        else:
+            (version, state) = GLOBALS[G_STATUS].snapshot()
+        return {'ok': True, 'status': status_dict(version, state)}
+
+    if command_key == CMD_SEARCH:
+        if not isinstance(request.get('arg'), str) or not request['arg'].strip():
+            return {'ok': False, 'error': 'search needs the text to look for'}
+        command = post_command(CMD_SEARCH, request['arg'].strip())
+    elif command_key in CONTROL_COMMANDS:
+        command = post_command(command_key)
+    else:
+        return {'ok': False, 'error': f'unknown command { command_key }'}
+
+    result = command.wait(CONTROL_TIMEOUT)
+    (version, state) = GLOBALS[G_STATUS].snapshot()
+    if result is None:
+        return {'ok': False, 'error': 'timed out', 'status': status_dict(version, state)}
+    return {'ok': True, 'result': result, 'status': status_dict(version, state)}
+
+
+##########################################################################################
+class ControlServer():
+    ''' listens on a Unix domain socket for requests from local scripts, buttons
+        and "tvh_radio.py --send", one per line, replying to each with a line of
+        JSON; each connection has its own thread and can send many requests '''
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.listen_sock = None
+
+    def start(self):
+        ''' starts listening, taking over a socket left by a radio which didn't shut
+            down cleanly; returns self, or None if the socket can't be used '''
+
+        if os.path.exists(self.socket_path):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe_sock:
+                    probe_sock.connect(self.socket_path)
+                print(f'Warning, another radio is using { self.socket_path }, control socket is off')
+                return None
+            except OSError:
+                # nothing answered, so it was left behind
+                try:
+                    os.unlink(self.socket_path)
+                except OSError:
+                    pass
+
+        self.listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # the socket is made with only the user's permissions so it's never open to
+        # others, the umask is for the whole process so it's put back straight away
+        old_umask = os.umask(0o177)
+        try:
+            self.listen_sock.bind(self.socket_path)
+            self.listen_sock.listen()
+        except OSError as sock_err:
+            print(f'Warning, couldn\'t listen on { self.socket_path }, { sock_err }')
+            self.listen_sock.close()
+            return None
+        finally:
+            os.umask(old_umask)
+
+        return self
+
+    def run(self):
+        ''' the thread which accepts connections until shutdown '''
+
+        while not GLOBALS[G_SHUTDOWN].is_set():
+            readable, _o, _e = select.select([self.listen_sock, GLOBALS[G_SHUTDOWN].wake_fd],
+                                             [], [])
+            if self.listen_sock in readable and not GLOBALS[G_SHUTDOWN].is_set():
+                (conn, _address) = self.listen_sock.accept()
+                Thread(target=self.serve_connection, args=(conn, ), daemon=True).start()
+
+        self.listen_sock.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def serve_connection(conn):
+        ''' replies to each request line on a connection until the client closes it '''
+
+        try:
+            with conn, conn.makefile('rb') as conn_reader:
+                for request_line in iter(lambda: conn_reader.readline(CONTROL_LINE_MAX), b''):
+                    request_text = request_line.decode('utf-8', errors='replace').strip()
+                    if request_text:
+                        reply = control_reply(request_text)
+                        conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        except OSError:
+            pass
+
+
+##########################################################################################
+def control_client(request_texts):
+    ''' sends requests to the control socket of a running radio, printing the
+        result of each, or the status for a status request; returns the exit status '''
+
+    socket_path = os.path.join(os.environ['HOME'], SETTINGS_DIR, CONTROL_SOCKET)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control_sock:
+            control_sock.connect(socket_path)
+            with control_sock.makefile('rb') as control_reader:
+                for request_text in request_texts:
+                    control_sock.sendall(request_text.encode('utf-8') + b'\n')
+                    reply = json.loads(control_reader.readline())
+                    if not reply.get('ok'):
+                        print(f'Error, { request_text }: { reply.get("error") }')
+                        return 1
+                    if 'result' in reply:
+                        print(reply['result'])
+                    else:
+                        print(json.dumps(reply['status']))
+    except (OSError, ValueError) as control_err:
+        print(f'Error, couldn\'t talk to the radio on { socket_path }, { control_err }')
+        return 1
+
+    return 0
+
+
+##########################################################################################
+class FavouritesStore():
+    ''' the favourites, kept as a dict of name to URL plus a list of the names
+        in sorted order, so a toggle is a bisect rather than a re-sort; changes
+        are saved once they stop coming for FAV_SAVE_DELAY seconds '''
+
+    def __init__(self, file_name, save_delay=FAV_SAVE_DELAY):
+        self.file_name = file_name
+        self.save_delay = save_delay
+        self.lock = Lock()
+        self.timer = None
+        self.saved_stat = None      # the file as we last wrote it
+        self.urls = read_list_file(file_name)
+        self.names = sorted(self.urls)
+
+    def __contains__(self, chan_name):
+        return chan_name in self.urls
+
+    def __len__(self):
+        return len(self.names)
+
+    def items(self):
+        ''' the favourites in name order, like dict.items() '''
+
+        return ((chan_name, self.urls[chan_name]) for chan_name in self.names)
+
+    def toggle(self, chan_name, chan_url):
+        ''' adds the channel if it isn't a favourite and removes it if it is,
+            returns True if it was added '''
+
+        with self.lock:
+            pos = bisect.bisect_left(self.names, chan_name)
+            added = chan_name not in self.urls
+            if added:
+                self.names.insert(pos, chan_name)
+                self.urls[chan_name] = chan_url
+            else:
+                del self.names[pos]
+                del self.urls[chan_name]
+            self.schedule_save_locked()
+
+        return added
+
+    def schedule_save_locked(self):
+        ''' (re)start the save timer, with the lock already held '''
+
+        if self.timer:
+            self.timer.cancel()
+        self.timer = Timer(self.save_delay, self.save)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def save(self):
+        ''' writes the favourites file, called by the timer '''
+
+        with self.lock:
+            self.timer = None
+            list_data = dict(self.items())
+            if GLOBALS[G_DBG_LEVEL]: print(f'Debug, saving { len(list_data) } favourites')
+            write_list_file(FAVOURITES_HDR, self.file_name, list_data)
+            self.saved_stat = list_file_stat(self.file_name)
+
+    def reload(self):
+        ''' re-reads the file after it was changed by something else, returns the
+            tuple (added, removed, changed) like diff_chan_maps, or None if the
+            change was our own save '''
+
+        with self.lock:
+            if list_file_stat(self.file_name) == self.saved_stat:
+                return None
+            (added, removed, changed) = diff_chan_maps(self.urls, read_list_file(self.file_name))
+            for chan_name in removed:
+                del self.names[bisect.bisect_left(self.names, chan_name)]
+                del self.urls[chan_name]
+            for chan_name in added:
+                bisect.insort(self.names, chan_name)
+            self.urls.update(added)
+            self.urls.update(changed)
+
+        return (added, removed, changed)
+
+    def flush(self):
+        ''' saves now if there are changes waiting to be saved '''
+
+        with self.lock:
+            pending = self.timer is not None
+            if pending:
+                self.timer.cancel()
+        if pending:
+            self.save()
+
+
+##########################################################################################
+def list_file_stat(file_name):
+    ''' returns what identifies a version of a list file, or None if it's missing '''
+
+    try:
+        file_stat = os.stat(file_name)
+    except OSError:
+        return None
+
+    return (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+
+##########################################################################################
+class ListFileWatcher():
+    ''' watches list files in a directory and posts a CMD_LIST_RELOAD command when
+        one is saved; uses inotify through the C library where it's available,
+        otherwise checks the files' modification times every LIST_POLL_SECS '''
+
+    def __init__(self, list_dir, file_names):
+        self.list_dir = list_dir
+        self.file_names = file_names
+
+    def run(self):
+        ''' the thread which watches the files until shutdown '''
+
+        inotify_fd = self.inotify_init()
+        if inotify_fd is None:
+            if GLOBALS[G_DBG_LEVEL]: print('Debug, no inotify, polling list files')
+            self.watch_polling()
+        else:
+            try:
+                self.watch_inotify(inotify_fd)
+            finally:
+                os.close(inotify_fd)
+
+    def inotify_init(self):
+        ''' returns an inotify file descriptor watching the directory, or None '''
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (AttributeError, OSError):
+            return None
+        if inotify_fd < 0:
+            return None
+
+        if libc.inotify_add_watch(inotify_fd, os.fsencode(self.list_dir),
+                                  IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(inotify_fd)
+            return None
+
+        return inotify_fd
+
+    def watch_inotify(self, inotify_fd):
+        ''' waits for inotify events, several saves of a file in one read are one reload '''
+
+        while not GLOBALS[G_SHUTDOWN].is_set():
+            readable, _o, _e = select.select([inotify_fd, GLOBALS[G_SHUTDOWN].wake_fd], [], [])
+            if inotify_fd not in readable:
+                continue
+            try:
+                events = os.read(inotify_fd, 65536)
+            except BlockingIOError:
+                continue
+
+            changed_files = set()
+            offset = 0
+            while offset < len(events):
+                (_wd, _mask, _cookie, name_len) = struct.unpack_from('iIII', events, offset)
+                offset += struct.calcsize('iIII')
+                file_name = events[offset:offset + name_len].rstrip(b'\0').decode(errors='replace')
+                offset += name_len
+                if file_name in self.file_names:
+                    changed_files.add(file_name)
+
+            for file_name in changed_files:
+                post_command(CMD_LIST_RELOAD, file_name)
+
+    def watch_polling(self):
+        ''' checks each file for a change of inode, modification time or size '''
+
+        file_stats = {file_name: list_file_stat(os.path.join(self.list_dir, file_name))
+                      for file_name in self.file_names}
+        while not GLOBALS[G_SHUTDOWN].wait(LIST_POLL_SECS):
+            for file_name in self.file_names:
+                file_stat = list_file_stat(os.path.join(self.list_dir, file_name))
+                if file_stat != file_stats[file_name]:
+                    file_stats[file_name] = file_stat
+                    post_command(CMD_LIST_RELOAD, file_name)
+
+
+##########################################################################################
+def find_chan_num(chan_names, chan_name, chan_num):
+    ''' returns the position of chan_name in a changed channel list, or if it's gone,
+        chan_num kept within the list '''
+
+    if chan_name in chan_names:
+        return chan_names.index(chan_name)
+
+    return max(min(chan_num, len(chan_names) - 1), 0)
+
+
+##########################################################################################
+def probe_stream(stream_url):
+    ''' opens a stream the way a player would and times it, returns a dict with
+        ok, the seconds to connect and from the request to the first byte, the
+        kilobytes per second of the PROBE_BYTES which follow, and any error '''
+
+    probe = {'ok': False, 'connect': None, 'first_byte': None, 'kbps': None,
+             'error': '', 'when': time.time()}
+    try:
+        for _redirect in range(PROBE_REDIRECTS + 1):
+            url_parts = urllib.parse.urlsplit(stream_url)
+            if url_parts.scheme == 'https':
+                connection = http.client.HTTPSConnection(url_parts.hostname, url_parts.port,
+                                                         timeout=PROBE_TIMEOUT)
+            elif url_parts.scheme == 'http':
+                connection = http.client.HTTPConnection(url_parts.hostname, url_parts.port,
+                                                        timeout=PROBE_TIMEOUT)
+            else:
+                probe['error'] = f'cannot check { url_parts.scheme } URLs'
+                return probe
+
+            try:
+                time_start = time.monotonic()
+                connection.connect()
+                probe['connect'] = time.monotonic() - time_start
+
+                request_path = url_parts.path or '/'
+                if url_parts.query:
+                    request_path += f'?{ url_parts.query }'
+                time_start = time.monotonic()
+                connection.request('GET', request_path, headers={'User-Agent': G_TTS_UA})
+                response = connection.getresponse()
+                if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                    stream_url = urllib.parse.urljoin(stream_url, response.getheader('Location'))
+                    continue
+                if response.status != 200:
+                    probe['error'] = f'HTTP { response.status } { response.reason }'
+                    return probe
+
+                first_byte = response.read(1)
+                probe['first_byte'] = time.monotonic() - time_start
+                if not first_byte:
+                    probe['error'] = 'no data'
+                    return probe
+
+                time_start = time.monotonic()
+                body = response.read(PROBE_BYTES)
+                read_secs = time.monotonic() - time_start
+                probe['kbps'] = len(body) / 1024 / read_secs if read_secs > 0 else None
+                probe['ok'] = True
+                return probe
+
+            finally:
+                connection.close()
+
+        probe['error'] = 'too many redirects'
+
+    except (OSError, http.client.HTTPException) as probe_err:
+        probe['error'] = str(probe_err) or probe_err.__class__.__name__
+
+    return probe
+
+
+##########################################################################################
+def probe_text(probe):
+    ''' describes a probe result in a few words '''
+
+    if not probe['ok']:
+        return f'dead, { probe["error"] }'
+
+    probe_words = f'connect { probe["connect"] * 1000:.0f}ms, ' \
+                  f'first byte { probe["first_byte"] * 1000:.0f}ms'
+    if probe['kbps']:
+        probe_words += f', { probe["kbps"]:.0f}kB/s'
+
+    return probe_words
+
+
+##########################################################################################
+class StreamProber():
+    ''' checks streams concurrently with a bounded thread pool and keeps the
+        latest result for each URL '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.results = {}   # stream URL => dict from probe_stream
+
+    def probe(self, stream_urls, workers=PROBE_WORKERS, keep_going=None):
+        ''' probes all the URLs with at most workers at a time; keep_going is
+            called before each URL, and a URL is skipped if it returns False '''
+
+        def probe_one(stream_url):
+            # a player may manage other kinds of stream, so those are left unknown
+            if urllib.parse.urlsplit(stream_url).scheme not in ('http', 'https'):
+                return
+            if keep_going and not keep_going():
+                return
+            probe = probe_stream(stream_url)
+            with self.lock:
+                self.results[stream_url] = probe
+            if GLOBALS[G_DBG_LEVEL]: print(f'Debug, probed { stream_url } : { probe_text(probe) }')
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='probe') as pool:
+            list(pool.map(probe_one, stream_urls))
+
+    def result(self, stream_url):
+        ''' returns the latest result for stream_url, or None if not probed yet '''
+
+        with self.lock:
+            return self.results.get(stream_url)
+
+    def is_dead(self, stream_url):
+        ''' True if the last probe of stream_url failed '''
+
+        probe = self.result(stream_url)
+        return probe is not None and not probe['ok']
+
+    def ranked(self, chan_map):
+        ''' returns a list of tuple (name, result) for the probed channels in
+            chan_map, quickest to the first byte first and dead ones last '''
+
+        probed = [(chan_name, self.result(chan_url)) for (chan_name, chan_url) in chan_map.items()]
+        return sorted(((chan_name, probe) for (chan_name, probe) in probed if probe),
+                      key=lambda chan_probe: (not chan_probe[1]['ok'],
+                                              chan_probe[1]['first_byte'] or 0))
+
+
+##########################################################################################
+def stream_probe_thread(streams_chan_map, favourites, tvh_chan_map):
+    ''' probes every stream every PROBE_INTERVAL minutes; the maps are changed in
+        place by the main loop, so they are copied before each round. TVH channels
+        are probed one at a time and not while playing, as each takes a tuner '''
+
+    global GLOBALS
+
+    probe_secs = float(get_setting(PROBE_INTERVAL)) * 60
+    while not GLOBALS[G_SHUTDOWN].is_set():
+        stream_urls = set(streams_chan_map.values()) | set(favourites.urls.values())
+        tvh_urls = set(tvh_chan_map.values()) - stream_urls
+        GLOBALS[G_PROBER].probe(stream_urls, keep_going=lambda: not GLOBALS[G_SHUTDOWN].is_set())
+        GLOBALS[G_PROBER].probe(tvh_urls, workers=1,
+                                keep_going=lambda: GLOBALS[G_PLAYER] is None and
+                                not GLOBALS[G_SHUTDOWN].is_set())
+        publish_status()
+        if GLOBALS[G_SHUTDOWN].wait(probe_secs):
+            break
+
+
+##########################################################################################
+def skip_dead_chans(chan_names, chan_map, chan_num, step):
+    ''' returns the first channel from chan_num going in direction step whose
+        stream isn't known to be dead, or chan_num if they all are '''
+
+    for next_num in range(chan_num, len(chan_names) if step > 0 else -1, step):
+        if not GLOBALS[G_PROBER].is_dead(chan_map[chan_names[next_num]]):
+            return next_num
+
+    return chan_num
+
+
+##########################################################################################
+def probe_report():
+    ''' probes the streams, favourites and TVH channels once and prints each list
+        ranked by how quickly the streams answer, for --probe '''
+
+    global GLOBALS
+
+    GLOBALS[G_PROBER] = StreamProber()
+    chan_lists = (
+        ('Streams', read_list_file(os.path.join(os.environ['HOME'], SETTINGS_DIR, STREAMS_LIST))),
+        ('Favourites', read_list_file(os.path.join(os.environ['HOME'], SETTINGS_DIR,
+                                                   FAVOURITES_LIST))),
+        ('TVH channels', load_tvh_chan_cache().get('channels') or get_tvh_chan_urls()),
+    )
+
+    for (list_name, chan_map) in chan_lists:
+        print(f'=== { list_name } ===')
+        GLOBALS[G_PROBER].probe(set(chan_map.values()),
+                                workers=1 if list_name == 'TVH channels' else PROBE_WORKERS)
+        for (chan_name, probe) in GLOBALS[G_PROBER].ranked(chan_map):
+            print(f'\t{ chan_name } : { probe_text(probe) }')
+
+
+##########################################################################################
+def metric_labels(labels, extra=''):
+    ''' returns the Prometheus label set for a tuple of (name, value) pairs '''
+
+    label_text = ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                       .replace('"', '\\"').replace('\n', '\\n'))
+                          for (name, value) in labels)
+    if extra:
+        label_text = f'{ label_text },{ extra }' if label_text else extra
+    return f'{{{ label_text }}}' if label_text else ''
+
+
+##########################################################################################
+class Counter():
+    ''' a Prometheus counter, one count for each set of label values '''
+
+    def __init__(self, name, help_text):
+        self.name = METRICS_PREFIX + name
+        self.help_text = help_text
+        self.lock = Lock()
+        self.counts = {}    # tuple of label pairs => count
+
+    def inc(self, **labels):
+        ''' adds one to the count for the labels '''
+
+        label_key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.counts[label_key] = self.counts.get(label_key, 0) + 1
+
+    def exposition(self):
+        ''' returns the lines of the Prometheus text format '''
+
+        lines = [f'# HELP { self.name } { self.help_text }', f'# TYPE { self.name } counter']
+        with self.lock:
+            for (label_key, count) in sorted(self.counts.items()):
+                lines.append(f'{ self.name }{ metric_labels(label_key) } { count }')
+        return lines
+
+
+##########################################################################################
+class Histogram():
+    ''' a Prometheus histogram of seconds, with cumulative buckets for each set
+        of label values '''
+
+    def __init__(self, name, help_text, buckets=METRICS_BUCKETS):
+        self.name = METRICS_PREFIX + name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.lock = Lock()
+        self.series = {}    # tuple of label pairs => [bucket counts, sum, count]
+
+    def observe(self, secs, **labels):
+        ''' records a time for the labels '''
+
+        label_key = tuple(sorted(labels.items()))
+        bucket_num = bisect.bisect_left(self.buckets, secs)
+        with self.lock:
+            series = self.series.setdefault(label_key, [[0] * len(self.buckets), 0.0, 0])
+            if bucket_num < len(self.buckets):
+                series[0][bucket_num] += 1
+            series[1] += secs
+            series[2] += 1
+
+    def exposition(self):
+        ''' returns the lines of the Prometheus text format '''
+
+        lines = [f'# HELP { self.name } { self.help_text }', f'# TYPE { self.name } histogram']
+        with self.lock:
+            for (label_key, (bucket_counts, secs_sum, count)) in sorted(self.series.items()):
+                cumulative = 0
+                for (bucket, bucket_count) in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    bucket_labels = metric_labels(label_key, 'le="%s"' % (bucket, ))
+                    lines.append(f'{ self.name }_bucket{ bucket_labels } { cumulative }')
+                bucket_labels = metric_labels(label_key, 'le="+Inf"')
+                lines.append(f'{ self.name }_bucket{ bucket_labels } { count }')
+                lines.append(f'{ self.name }_sum{ metric_labels(label_key) } { secs_sum }')
+                lines.append(f'{ self.name }_count{ metric_labels(label_key) } { count }')
+        return lines
+
+
+##########################################################################################
+class RadioMetrics():
+    ''' where the time goes, from a key press through to the player, for the
+        web /metrics in the Prometheus text format '''
+
+    def __init__(self):
+        self.command_wait = Histogram('command_wait_seconds',
+                                      'Time from a command being posted to the main loop starting it')
+        self.command_run = Histogram('command_run_seconds',
+                                     'Time the main loop took to act on a command')
+        self.player_spawn = Histogram('player_spawn_seconds',
+                                      'Time from the play command to the player process starting')
+        self.player_run = Histogram('player_run_seconds', 'Time each player process ran for')
+        self.player_exits = Counter('player_exits_total',
+                                    'Player exits, stopped by us or unexpected')
+        self.tvh_api = Histogram('tvh_api_seconds', 'Time taken by TVH API requests')
+
+    def exposition(self):
+        ''' returns all the metrics as bytes in the Prometheus text format '''
+
+        lines = []
+        for metric in (self.command_wait, self.command_run, self.player_spawn,
+                       self.player_run, self.player_exits, self.tvh_api, ):
+            lines.extend(metric.exposition())
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+##########################################################################################
+class Profiler():
+    ''' profiles where the CPU time goes with cProfile and where memory is allocated
+        with tracemalloc, leaving out the profiler's own allocations.
+
+        Up to Python 3.11 cProfile only sees the thread which enabled it, so every
+        thread started afterwards gets its own profile, and those of threads which
+        have ended are merged so short lived web request threads don't pile up.
+        From 3.12 cProfile is built on sys.monitoring, which allows only one
+        profile at a time but sees every thread, so one profile is used. '''
+
+    def __init__(self):
+        self.profile_dir = os.path.join(os.environ['HOME'], SETTINGS_DIR, PROFILES_DIR)
+        self.lock = Lock()
+        self.started = time.monotonic()
+        self.profiles = []          # (thread, profile) of threads which were running
+        self.finished = None        # pstats.Stats of the threads which have ended
+        self.last_snapshot = None   # memory at the last dump, to show what grew
+
+    def start(self):
+        ''' starts profiling this thread and all those started after it, returns self '''
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        tracemalloc.start(PROFILE_FRAMES)
+        if PROFILE_PER_THREAD:
+            setprofile(self.thread_started)
+            self.thread_started()
+        else:
+            # the threads share the profile, so the process CPU time is used
+            profile = cProfile.Profile(time.process_time)
+            self.profiles.append((current_thread(), profile))
+            profile.enable()
+        return self
+
+    def thread_started(self, *_args):
+        ''' starts a profile of the calling thread, set with threading.setprofile()
+            so each new thread calls it first '''
+
+        # CPU time of the thread, so threads waiting on the network don't swamp the busy ones
+        profile = cProfile.Profile(time.thread_time)
+        with self.lock:
+            self.merge_finished()
+            self.profiles.append((current_thread(), profile))
+        profile.enable()
+
+    @staticmethod
+    def profile_stats(profile):
+        ''' returns the statistics of a profile while leaving it running; disabling
+            it would stop the profile of the calling thread instead of its own '''
+
+        profile.snapshot_stats()
+        stats = pstats.Stats()
+        stats.stats = profile.stats
+        stats.get_top_level_stats()
+        return stats
+
+    def merge_finished(self):
+        ''' merges the profiles of threads which have ended, call with the lock held '''
+
+        running = []
+        for (thread, profile) in self.profiles:
+            if thread.is_alive():
+                running.append((thread, profile))
+            elif self.finished:
+                self.finished.add(self.profile_stats(profile))
+            else:
+                self.finished = self.profile_stats(profile)
+        self.profiles = running
+
+    def dump(self, reason):
+        ''' writes the statistics so far to the profiles directory, a .prof file for
+            pstats or snakeviz and a .txt report of the busiest functions, the largest
+            allocation sites and what grew since the last dump; returns the report name '''
+
+        combined = pstats.Stats()
+        with self.lock:
+            self.merge_finished()
+            if self.finished:
+                combined.add(self.finished)
+            for (_thread, profile) in self.profiles:
+                combined.add(self.profile_stats(profile))
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, '*/linecache.py'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+        (traced, traced_peak) = tracemalloc.get_traced_memory()
+        try:
+            with open('/proc/self/statm', encoding='ascii') as fh_statm:
+                rss = int(fh_statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            rss = 0
+
+        time_stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        base_name = os.path.join(self.profile_dir, f'profile_{ time_stamp }_{ reason }')
+        combined.dump_stats(base_name + '.prof')
+        with open(base_name + '.txt', 'w', encoding='utf-8') as fh_report:
+            fh_report.write(f'tvh_radio profile, { reason }, after '
+                            f'{ time.monotonic() - self.started:.0f} seconds\n\n')
+            combined.stream = fh_report
+            combined.sort_stats('cumulative').print_stats(PROFILE_TOP)
+            combined.sort_stats('tottime').print_stats(PROFILE_TOP)
+
+            fh_report.write(f'Memory: RSS { rss // 1024 } KiB, maximum RSS '
+                            f'{ resource.getrusage(resource.RUSAGE_SELF).ru_maxrss } KiB, '
+                            f'traced { traced // 1024 } KiB, traced peak { traced_peak // 1024 } KiB\n')
+            fh_report.write('\nLargest allocation sites\n')
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+                fh_report.write(f'{ stat }\n')
+            if self.last_snapshot:
+                fh_report.write('\nGrowth since the last dump\n')
+                for stat in snapshot.compare_to(self.last_snapshot, 'lineno')[:PROFILE_TOP]:
+                    fh_report.write(f'{ stat }\n')
+            fh_report.write('\nLargest allocation stacks\n')
+            for stat in snapshot.statistics('traceback')[:PROFILE_TRACEBACKS]:
+                fh_report.write(f'\n{ stat }\n')
+                for line in stat.traceback.format():
+                    fh_report.write(f'{ line }\n')
+
+        self.last_snapshot = snapshot
+        return base_name + '.txt'
+
+
+##########################################################################################
+class RadioStatus():
+    ''' a snapshot of the radio's state for the web interface, published by whatever
+        changes it; each change bumps the version and wakes anyone waiting for a
+        change, and the status page is rendered once per version and kept as bytes '''
+
+    def __init__(self):
+        self.cond = Condition()
+        self.version = 0
+        self.state = {}
+        self.pages = {}     # with or without the refresh header => page bytes
+
+    def publish(self):
+        ''' takes a fresh snapshot of the state, bumping the version if it changed '''
+
+        global GLOBALS
+
+        state = {
+            'mode': GLOBALS[G_RADIO_MODE],
+            'playing': GLOBALS[G_CHAN_NAME_PLAYING] if GLOBALS[G_PLAYER_PID] != 0 else '',
+            'future': GLOBALS[G_CHAN_NAME_FUTURE],
+            'stopping': bool(GLOBALS[G_STOP_PLAYBACK]),
+            'relay': GLOBALS[G_PLAYING_FEED] is not None and get_setting(RELAY) == '1',
+            'paused': bool(GLOBALS[G_TIMESHIFT] and GLOBALS[G_TIMESHIFT].paused_pos is not None),
+            'recording': GLOBALS[G_RECORDER].chan_name if GLOBALS[G_RECORDER] else '',
+            'future_probe': GLOBALS[G_PROBER].result(GLOBALS[G_CHAN_URL_FUTURE])
+                            if GLOBALS[G_PROBER] else None,
+        }
+        with self.cond:
+            if state != self.state:
+                self.state = state
+                self.version += 1
+                self.pages = {}
+                self.cond.notify_all()
+
+    def snapshot(self):
+        ''' returns tuple (version, state) '''
+
+        with self.cond:
+            return (self.version, dict(self.state))
+
+    def wait_change(self, since, timeout):
+        ''' waits up to timeout seconds for the version to differ from since,
+            returns tuple (version, state) '''
+
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != since or GLOBALS[G_SHUTDOWN].is_set(),
+                               timeout)
+            return (self.version, dict(self.state))
+
+    def wake(self):
+        ''' wakes everybody waiting for a change, used at shutdown '''
+
+        with self.cond:
+            self.cond.notify_all()
+
+    def page(self, refresh):
+        ''' returns the status page as bytes, with a refresh header if refresh is True '''
+
+        with self.cond:
+            if refresh not in self.pages:
+                self.pages[refresh] = render_status_page(self.state, self.version, refresh)
+            return self.pages[refresh]
+
+
+def publish_status():
+    ''' tells the web interface the radio's state may have changed '''
+
+    global GLOBALS
+
+    if GLOBALS[G_STATUS]:
+        GLOBALS[G_STATUS].publish()
+
+
+##########################################################################################
+def render_status_page(state, version, refresh):
+    ''' renders the remote control page for a state snapshot, returns bytes '''
+
+    global GLOBALS
+
+    if refresh:
+        # refresh after entering a command, not too quickly as the
+        # user might be quickly changing channels
+        no_push = '<noscript><meta http-equiv="refresh" content="3;/"></noscript>'
+    else:
+        no_push = ''
+    extra_header = WEB_PUSH % (version, no_push, )
+
+    if state.get('playing'):
+        if state['stopping']:
+            status_playing = '<tr><td align="right">playing</td>' \
+                             f'<td>{ html.escape(state["playing"]) } but stopping soon</td></tr>\n'
+        else:
+            status_playing = '<tr><td align="right">playing</td>' \
+                             f'<td>{ html.escape(state["playing"]) }</td></tr>\n'
+    else:
+        status_playing = ''
+
+    if state.get('future'):
+        channel_future = '<tr><td align="right">playing in future</td>' \
+                         f'<td>{ html.escape(state["future"]) }</td></tr>\n'
+    else:
+        channel_future = ''
+
+    if state.get('paused'):
+        status_playing += '<tr><td align="right">paused</td><td>press pause to resume</td></tr>\n'
+
+    if state.get('recording'):
+        status_playing += '<tr><td align="right">recording</td>' \
+                          f'<td>{ html.escape(state["recording"]) }</td></tr>\n'
+
+    if state.get('relay'):
+        status_playing += '<tr><td align="right">listen</td>' \
+                          f'<td><a href="{ RELAY_PATH }">{ RELAY_PATH }</a></td></tr>\n'
+
+    if state.get('future_probe'):
+        future_probe = '<tr><td align="right">stream check</td>' \
+                       f'<td>{ html.escape(probe_text(state["future_probe"])) }</td></tr>\n'
+    else:
+        future_probe = ''
+
+    radio_mode = '<tr><td align="right">radio mode</td>'    \
+                 f'<td>{ RM_TEXT.get(state.get("mode"), "") }</td></tr>'
+    status_complete = f'{ radio_mode }{ status_playing }{ channel_future }{ future_probe }'
+
+    favicon_url = f'{ GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_URL] }/favicon.ico'
+    return (WEB_HEAD % (favicon_url, extra_header, ) +
+            WEB_BODY % (status_complete, )).encode('utf-8')
+
+
+##########################################################################################
+def status_dict(version, state):
+    ''' returns the status snapshot as a dict for the APIs '''
+
+    return {
+        'version': version,
+        'mode': state.get('mode', ''),
+        'mode_text': RM_TEXT.get(state.get('mode'), ''),
+        'playing': state.get('playing', ''),
+        'future': state.get('future', ''),
+        'stopping': state.get('stopping', False),
+        'relay': RELAY_PATH if state.get('relay') else '',
+        'paused': state.get('paused', False),
+        'recording': state.get('recording', ''),
+        'future_probe': state.get('future_probe'),
+    }
+
+
+##########################################################################################
+def status_json(version, state):
+    ''' returns the status snapshot as JSON bytes for the web API '''
+
+    return json.dumps(status_dict(version, state)).encode('utf-8')
+
+
+##########################################################################################
+def load_web_assets():
+    ''' reads the web interface icons into memory once, from the directory next
+        to this script rather than wherever we were started from
+
+    returns a dict, key is the URL path, value is tuple (content, strong ETag)
+    '''
+
+    asset_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), WEB_ASSET_DIR)
+    web_assets = {}
+    for asset_name in WEB_ASSETS:
+        try:
+            with open(os.path.join(asset_dir, asset_name), 'rb') as fh_asset:
+                content = fh_asset.read()
+        except OSError as asset_err:
+            print(f'Warning, web interface icon missing, { asset_err }')
+            continue
+        etag = '"%s"' % (hashlib.sha1(content).hexdigest(), )
+        web_assets[f'/{ WEB_ASSET_DIR }/{ asset_name }'] = (content, etag)
+
+    return web_assets
+
+
+##########################################################################################
+class MyHTTPRequestHandler():
+    ''' minimal http request handler for remote control, mixed in with
+        BaseHTTPRequestHandler by make_web_server() '''
+
+    protocol_version = 'HTTP/1.1'
+
     def do_GET(self):   # pylint:disable=invalid-name
         ''' implement the http GET method '''
 
         global GLOBALS
 
-        uri_get_regex = re.compile(r'GET (.*) HTTP.*')
-        re_matches = uri_get_regex.match(self.requestline)
-        if re_matches:
-            uri = re_matches.group(1)
-        else:
-            uri = '/'	# fallback, but it should never get here
+        (_scheme, _netloc, uri, query, _fragment) = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(query)
+
+        if uri == '/api/status':
+            self.send_status(params)
+            return
+
+        if uri == '/api/events':
+            self.send_events(params)
+            return
+
+        if uri == RELAY_PATH:
+            self.send_relay()
+            return
+
+        if uri == METRICS_PATH:
+            metrics = GLOBALS[G_METRICS].exposition()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(metrics)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(metrics)
+            return
 
         if '.png' in uri:
-            print('Debug, attempting to send image')
-            SimpleHTTPRequestHandler.do_GET(self)
+            self.send_asset(uri)
+            return
+
+        # miss off the leading /, the page is sent once the command has been done so
+        # it shows the result, or after WEB_COMMAND_TIMEOUT if the main loop is busy
+        if uri[1:] in VALID_WEB_COMMANDS:
+            post_command(uri[1:]).wait(WEB_COMMAND_TIMEOUT)
+            page = GLOBALS[G_STATUS].page(True)
+        elif params.get('q', [''])[0].strip():
+            post_command(CMD_SEARCH, params['q'][0].strip()).wait(WEB_COMMAND_TIMEOUT)
+            page = GLOBALS[G_STATUS].page(True)
         else:
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
+            page = GLOBALS[G_STATUS].page(False)
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def send_asset(self, uri):
+        ''' sends an icon from memory, or 304 if the browser's copy is current '''
+
+        global GLOBALS
+
+        if uri not in GLOBALS[G_WEB_ASSETS]:
+            self.send_error(404)
+            return
+
+        (content, etag) = GLOBALS[G_WEB_ASSETS][uri]
+        if_none_match = self.headers.get('If-None-Match', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match == '*':
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', f'public, max-age={ WEB_ASSET_MAX_AGE }')
             self.end_headers()
+            return
 
-            print('Debug, executing command and sending status')
-            # miss off the leading /
-            if uri[1:] in VALID_WEB_COMMANDS:
-                GLOBALS[G_KEY_STROKE] = uri[1:]
-                GLOBALS[G_EVENT].set()
-                time.sleep(0.5)
-                # refresh after entering a command, not too quickly as the
-                # user might be quickly changing channels
-                extra_header = '  <meta http-equiv="refresh" content="3;/">'
-            else:
-                extra_header = ''
+        self.send_response(200)
+        self.send_header('Content-type', 'image/png')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', f'public, max-age={ WEB_ASSET_MAX_AGE }')
+        self.end_headers()
+        self.wfile.write(content)
+
+    @staticmethod
+    def param_int(params, name, default):
+        ''' returns a query parameter as an integer '''
 
-            favicon_url = f'{ GLOBALS[G_MY_SETTINGS][SETTINGS_SECTION][TS_URL] }/favicon.ico'
-            self.wfile.write(bytearray(WEB_HEAD % (favicon_url, extra_header, ), encoding='ascii'))
+        try:
+            return int(params[name][0])
+        except (KeyError, IndexError, ValueError):
+            return default
+
+    def send_status(self, params):
+        ''' sends the status as JSON; with since=version and wait=seconds, it's a
+            long-poll which only answers when the version differs or on timeout '''
+
+        global GLOBALS
+
+        since = self.param_int(params, 'since', -1)
+        wait_secs = min(self.param_int(params, 'wait', 0), WEB_LONG_POLL_MAX)
+        if wait_secs > 0:
+            (version, state) = GLOBALS[G_STATUS].wait_change(since, wait_secs)
+        else:
+            (version, state) = GLOBALS[G_STATUS].snapshot()
 
-            if GLOBALS[G_PLAYER_PID] != 0:
-                if GLOBALS[G_STOP_PLAYBACK]:
-                    status_playing = '<tr><td align="right">playing</td>' \
-                                     f'<td>{ GLOBALS[G_CHAN_NAME_PLAYING] } but stopping soon</td></tr>\n'
+        body = status_json(version, state)
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, params):
+        ''' sends server-sent events, one for each change of status after the
+            version given by since, with comments to keep the connection alive '''
+
+        global GLOBALS
+
+        version = self.param_int(params, 'since', -1)
+
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        try:
+            while not GLOBALS[G_SHUTDOWN].is_set():
+                (new_version, state) = GLOBALS[G_STATUS].wait_change(version, WEB_EVENT_KEEPALIVE)
+                if new_version != version:
+                    version = new_version
+                    event = b'id: %d\ndata: %s\n\n' % (version, status_json(version, state), )
                 else:
-                    status_playing = '<tr><td align="right">playing</td>' \
-                                     f'<td>{ GLOBALS[G_CHAN_NAME_PLAYING] }</td></tr>\n'
-            else:
-                status_playing = ''
+                    event = b': keep-alive\n\n'
+                self.wfile.write(event)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
 
-            if GLOBALS[G_CHAN_NAME_FUTURE] != '':
-                channel_future = '<tr><td align="right">playing in future</td>' \
-                                 f'<td>{ GLOBALS[G_CHAN_NAME_FUTURE] }</td></tr>\n'
-            else:
-                channel_future = ''
 
-            radio_mode = '<tr><td align="right">radio mode</td>'    \
-                         f'<td>{ RM_TEXT[GLOBALS[G_RADIO_MODE]] }</td></tr>'
-            status_complete = f'{ radio_mode }{ status_playing }{ channel_future }'
+    def send_relay(self):
+        ''' relays the playing stream to a listener until it stops; every listener
+            is sent the same chunks from the feed, not copies of them '''
+
+        global GLOBALS
+
+        feed = GLOBALS[G_PLAYING_FEED]
+        if get_setting(RELAY) != '1' or feed is None:
+            self.send_error(404, 'Nothing is being relayed')
+            return
+        feed.connected.wait(float(get_setting(TS_TIMEOUT_CONNECT)))
+
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', feed.content_type or 'application/octet-stream')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        try:
+            for chunk in feed.chunks_from(feed.recent_seq(RELAY_BACKLOG)):
+                self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+##########################################################################################
+def make_web_server(bind_host, wport):
+    ''' returns the web server for remote control, http.server is imported here
+        so it only slows startup down if the web interface is used '''
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    handler_class = type('RadioHTTPRequestHandler',
+                         (MyHTTPRequestHandler, BaseHTTPRequestHandler, ), {})
+    # a thread per request, so one slow client doesn't hold up the others
+    httpd = ThreadingHTTPServer((bind_host, wport), handler_class)
+    httpd.daemon_threads = True
+    return httpd
 
-            self.wfile.write(bytearray(WEB_BODY % (status_complete, ), encoding='ascii'))
 
 ##########################################################################################
 #def start_web_listener(wport, bind_host):
@@ -781,28 +3597,64 @@ def start_web_listener(httpd):
 
 
 ##########################################################################################
-def radio_app():
-    '''this runs the radio appliance'''
+def radio_app(daemon=False):
+    '''this runs the radio appliance, without the keyboard when run as a daemon'''
 
     global GLOBALS
 
-    # read the streams file into a boringly simple dict
-    streams_chan_map = read_list_file(os.path.join(os.environ['HOME'],
-                                                   SETTINGS_DIR, STREAMS_LIST))
+    settings_dir = os.path.join(os.environ['HOME'], SETTINGS_DIR)
+
+    # handles on the threads
+    threads = {}
+    recorders = []                      # every recording, each has its own thread
+
+    # trap ctrl-x/sigint and sigterm so we can clean up
+    signal.signal(signal.SIGINT, sigint_handler)
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    if GLOBALS[G_PROFILER]:
+        signal.signal(signal.SIGUSR1, sigusr1_handler)
+
+    GLOBALS[G_PROBER] = StreamProber()
+    if float(get_setting(PREBUFFER_IDLE)) > 0:
+        GLOBALS[G_PREBUFFER] = PreBuffer(float(get_setting(PREBUFFER_IDLE)))
+    publish_status()
+
+    # read the streams, the favourites, the cached TVH channels and the speech
+    # cache index at the same time; none of them need the network, and they're
+    # done before any threads start so a failure here can't leave them running
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix='load') as loader:
+        streams_future = loader.submit(read_list_file, os.path.join(settings_dir, STREAMS_LIST))
+        favourites_future = loader.submit(FavouritesStore,
+                                          os.path.join(settings_dir, FAVOURITES_LIST))
+        tvh_cache_future = loader.submit(load_tvh_chan_cache)
+        tts_cache_future = loader.submit(TTSCache, os.path.join(settings_dir, TTS_DIR),
+                                         int(float(get_setting(TTS_CACHE_MB)) * 1024 * 1024),
+                                         make_tts_backend(get_setting(TTS_ENGINE)))
+
+    # the streams file as a boringly simple dict
+    streams_chan_map = streams_future.result()
     if streams_chan_map:
         print(f'There are { len(streams_chan_map) } streams')
 
-    # get the favourites; if favourites are empty change the default
-    # mode to TVH from favourites
-    favourites_chan_map = read_list_file(os.path.join(os.environ['HOME'],
-                                                      SETTINGS_DIR, FAVOURITES_LIST))
-    if favourites_chan_map:
-        print(f'There are { len(favourites_chan_map) } favourites')
+    favourites = favourites_future.result()
+    if favourites:
+        print(f'There are { len(favourites) } favourites')
+
+    # get the TVH channel map into the same format dict as the streams and favourites,
+    # using the cached copy straight away and checking it with the server in the
+    # background; with no cache, the channels are added as they arrive
+    tvh_chan_cache = tvh_cache_future.result()
+    if tvh_chan_cache:
+        tvh_chan_map = tvh_chan_cache['channels']
+        GLOBALS[G_TVH_CHAN_NUMBERS] = tvh_chan_cache.get('numbers', {})
+        print(f'Using { len(tvh_chan_map) } cached TVH channels')
     else:
-        GLOBALS[G_RADIO_MODE] = RM_TVH
+        tvh_chan_map = {}
 
-    # get the TVH channel map into the same format dict as the streams and favourites
-    tvh_chan_map = get_tvh_chan_urls()
+    # start in the first mode with channels ready, favourites if there are any;
+    # with nothing anywhere, TVH mode fills in when the server answers
+    if not favourites:
+        GLOBALS[G_RADIO_MODE] = RM_STR if streams_chan_map and not tvh_chan_map else RM_TVH
 
     if GLOBALS[G_RADIO_MODE] == RM_TVH:
         print('tvh radio mode')
@@ -812,210 +3664,432 @@ def radio_app():
         chan_map = streams_chan_map
     elif GLOBALS[G_RADIO_MODE] == RM_FAV:
         print('favourites radio mode')
-        chan_map = favourites_chan_map
+        chan_map = favourites.urls
     else:
         print('Error, invalid radio mode')
         sys.exit(1)
 
-    # sort and count channels for whatever mode we're in
-    chan_names = list(chan_map.keys())  # get an indexable array
+    # have all the channel names ready to be spoken
+    GLOBALS[G_TTS_CACHE] = tts_cache_future.result()
+    GLOBALS[G_TTS_CACHE].prewarm(time_speech_segments())
+    GLOBALS[G_TTS_CACHE].prewarm(chan_map.keys())
+
+    # sort and count channels for whatever mode we're in, the favourites are kept sorted
+    if GLOBALS[G_RADIO_MODE] == RM_FAV:
+        chan_names = favourites.names
+    else:
+        chan_names = list(chan_map.keys())  # get an indexable array
     max_chan = len(chan_map)            # max channel number
 
     chan_num = 0                        # start at first channel
+    chan_index = None                   # built when first searched
     GLOBALS[G_CHAN_NUM_FUTURE] = chan_num
-    GLOBALS[G_CHAN_NAME_FUTURE] = chan_names[chan_num]
+    GLOBALS[G_CHAN_NAME_FUTURE] = chan_names[chan_num] if chan_names else ''
+    GLOBALS[G_CHAN_URL_FUTURE] = chan_map[chan_names[chan_num]] if chan_names else ''
 
     ####
     # now we have the data, lets do the radio thing!
 
-    # trap ctrl-x/sigint so we can clean up
-    signal.signal(signal.SIGINT, sigint_handler)
-
-    # handles on the threads
-    threads = {}
+    publish_status()
 
-    # start a thread to listen to the keyboard
-    threads['KB'] = Thread(target=keyboard_listen_thread)
-    threads['KB'].start()
+    # the sockets are opened before the threads start too, a port in use is an error
+    control_server = ControlServer(os.path.join(settings_dir, CONTROL_SOCKET)).start()
 
-    # do we need to start a thread to act as the web server?
     if GLOBALS[G_MY_SETTINGS].get(SETTINGS_SECTION, WEB_PUBLIC) == '1':
         bind_host = ''
     else:
         bind_host = 'localhost'
     wport = GLOBALS[G_MY_SETTINGS].get(SETTINGS_SECTION, WEB_PORT)
-    if wport and wport != '' and wport.isnumeric():
-        httpd = HTTPServer((bind_host, int(wport)), MyHTTPRequestHandler)
-        threads['WWW'] = Thread(target=start_web_listener, args=(httpd, ))
-        threads['WWW'].start()
-
-    print('Playing next: %s' % (GLOBALS[G_CHAN_NAME_FUTURE], ))
-    # SIGINT and keyboard strokes and (one day) GPIO events all get funnelled here
-    while not GLOBALS[G_QUIT_FLAG]:
-        GLOBALS[G_EVENT].wait() # Blocks until the flag becomes true.
-        if GLOBALS[G_KEY_STROKE] != '':
-            if GLOBALS[G_KEY_STROKE] == 'A':   # secret key code :-)
-                api_test_func()
-
-            elif GLOBALS[G_KEY_STROKE] in ('?', 'h'):
-                print_help()
-
-            #elif GLOBALS[G_KEY_STROKE] == 'l':
-                #GLOBALS[G_DBG_LEVEL] and print('list')
-                #print('list')
-                #print(', '.join(chan_names))
-
-            elif GLOBALS[G_KEY_STROKE] == 'd':
-                #GLOBALS[G_DBG_LEVEL] and print('down')
-                if GLOBALS[G_DBG_LEVEL]: print('down')
-                if chan_num > 0:
-                    chan_num = chan_num - 1
-
-            elif GLOBALS[G_KEY_STROKE] == 'e':
-                if GLOBALS[G_DBG_LEVEL]: print('e')
-                streams_editor()
-
-            elif GLOBALS[G_KEY_STROKE] == 'E':
-                if GLOBALS[G_DBG_LEVEL]: print('E')
-                channel_editor(chan_map)
-                #max_chan = len(chan_map)
-                #chan_names = list(chan_map.keys())  # get an indexable array
-
-            elif GLOBALS[G_KEY_STROKE] == 'f':
-                if GLOBALS[G_DBG_LEVEL]: print('favourite')
-                if chan_names[chan_num] in favourites_chan_map:
-                    print('Removing channel %s to favourites' % (chan_names[chan_num], ))
-                    del favourites_chan_map[chan_names[chan_num]]
-                else:
-                    print(f'Adding channel { chan_names[chan_num] } to favourites')
-                    favourites_chan_map[chan_names[chan_num]] = chan_map[chan_names[chan_num]]
-                    favourites_chan_map = dict(sorted(favourites_chan_map.items()))
-                # re-count the channels
-                if GLOBALS[G_RADIO_MODE] == RM_FAV:
-                    max_chan = len(chan_map)
-                    chan_names = list(chan_map.keys())  # get an indexable array
-
-                save_favourites(favourites_chan_map)
-
-            elif GLOBALS[G_KEY_STROKE] == 'F':
-                if GLOBALS[G_DBG_LEVEL]: print('F')
-                if favourites_chan_map:
-                    print('Favourites:')
-                    print_channel_list('\t', favourites_chan_map)
-                else:
-                    print('Warning, no favourites set')
-
+    httpd = None
+    if wport and wport.isnumeric() and int(wport) > 0:
+        GLOBALS[G_WEB_ASSETS] = load_web_assets()
+        httpd = make_web_server(bind_host, int(wport))
+
+    # listen to the keyboard, the control socket and the web
+    if daemon:
+        print('Running as a daemon, control it with "tvh_radio.py --send" or the web')
+    else:
+        threads['KB'] = Thread(target=keyboard_listen_thread)
+        threads['KB'].start()
 
-            elif GLOBALS[G_KEY_STROKE] == 'm':
-                if GLOBALS[G_DBG_LEVEL]: print('mode')
-                # if changing mode, kill a running player
-                while GLOBALS[G_PLAYER_PID] != 0:
-                    print('Waiting to stop playback before changing mode')
-                    GLOBALS[G_STOP_PLAYBACK] = True
-                    time.sleep(1)
+    if control_server:
+        threads['CTL'] = Thread(target=control_server.run)
+        threads['CTL'].start()
 
-                # cycle between modes and choose the channel map for new mode
-                if GLOBALS[G_RADIO_MODE] == RM_TVH:
-                    GLOBALS[G_RADIO_MODE] = RM_STR
-                    chan_map = streams_chan_map
+    if httpd:
+        threads['WWW'] = Thread(target=start_web_listener, args=(httpd, ))
+        threads['WWW'].start()
 
-                elif GLOBALS[G_RADIO_MODE] == RM_STR:
-                    GLOBALS[G_RADIO_MODE] = RM_FAV
-                    chan_map = favourites_chan_map
+    # check the cached channel map with the TVH server, or get it if there's no cache
+    threads['TVH'] = Thread(target=tvh_chan_fetch_thread, args=(tvh_chan_cache, not tvh_chan_cache, ))
+    threads['TVH'].start()
 
-                elif GLOBALS[G_RADIO_MODE] == RM_FAV:
-                    GLOBALS[G_RADIO_MODE] = RM_TVH
-                    chan_map = tvh_chan_map
-                else:
-                    print('Error, mode change went wrong!')
-
-                print(f'Debug, mode is now { GLOBALS[G_RADIO_MODE] }')
-                chan_num = 0                        # start at first channel
-                chan_names = list(chan_map.keys())  # get an indexable array
-                max_chan = len(chan_map)            # max channel number
-
-
-            elif GLOBALS[G_KEY_STROKE] == 'p':
-                if GLOBALS[G_DBG_LEVEL]: print('play')
-                if GLOBALS[G_PLAYER_PID] != 0:
-                    print('Setting STOP_PLAYBACK true')
-                    GLOBALS[G_STOP_PLAYBACK] = True
-                    # wait for the sub process to finish, ugly polling hack!
-                    while GLOBALS[G_PLAYER_PID] != 0:
-                        print('Info, waiting to stop playback')
-                        time.sleep(1)
-                    # playback has finished
-                    threads['PB'].join()
-                    del threads['PB']
-                else:
-                    GLOBALS[G_CHAN_NAME_PLAYING] = chan_names[chan_num]
-                    print(f'attempting to play channel { chan_num }/{ chan_names[chan_num]}')
-                    stream_url = chan_map[chan_names[chan_num]]
-                    threads['PB'] = Thread(target=play_channel, args=(stream_url, ))
-                    threads['PB'].start()
-
-            elif GLOBALS[G_KEY_STROKE] == 'q':
-                print('Quit!')
-                GLOBALS[G_QUIT_FLAG] = 1
-                GLOBALS[G_STOP_PLAYBACK] = True
-                if GLOBALS[G_PLAYER_PID] != 0:
-                    # wait for the sub process to finish, ugly polling hack!
-                    while GLOBALS[G_PLAYER_PID] != 0:
-                        print('Info, waiting to stop playback')
-                        time.sleep(1)
-                    # playback has finished
-                    threads['PB'].join()
-                    del threads['PB']
-
-            elif GLOBALS[G_KEY_STROKE] == 's':
-                if GLOBALS[G_CHAN_NAME_PLAYING]:
-                    tts_file = chan_data_to_tts_file(GLOBALS[G_CHAN_NAME_PLAYING])
-                    play_file(tts_file)
-                else:
-                    print('Debug, not playing a channel so not speaking it\'s name')
-
-            elif GLOBALS[G_KEY_STROKE] == 'S':
-                print(f'Debug, speaking future channel name { GLOBALS[G_CHAN_NAME_FUTURE]}')
-                tts_file = chan_data_to_tts_file(GLOBALS[G_CHAN_NAME_FUTURE])
-                play_file(tts_file)
+    # pick up edits to the streams and favourites files without a restart
+    list_watcher = ListFileWatcher(settings_dir, (STREAMS_LIST, FAVOURITES_LIST, ))
+    threads['LST'] = Thread(target=list_watcher.run)
+    threads['LST'].start()
 
-            elif GLOBALS[G_KEY_STROKE] == 't':
-                play_time()
+    # check the streams in the background so dead ones are known about
+    if float(get_setting(PROBE_INTERVAL)) > 0:
+        threads['PRB'] = Thread(target=stream_probe_thread,
+                                args=(streams_chan_map, favourites, tvh_chan_map, ))
+        threads['PRB'].start()
 
-            elif GLOBALS[G_KEY_STROKE] == 'u':
-                if GLOBALS[G_DBG_LEVEL]: print('up')
-                if chan_num < max_chan - 1:
-                    chan_num = chan_num + 1
+    print('Playing next: %s' % (GLOBALS[G_CHAN_NAME_FUTURE], ))
+    # SIGINT and keyboard strokes and (one day) GPIO events all get funnelled here
+    # a command which goes wrong still shuts everything down, so nothing is left
+    # running and the terminal is put back
+    try:
+        while not GLOBALS[G_QUIT_FLAG]:
+            # blocks until something is posted, then takes everything queued
+            for command in get_commands():
+                if GLOBALS[G_QUIT_FLAG]:
+                    command.finish('quitting')
+                    continue
+
+                result = ''
+                command_started = time.monotonic()
+
+                # the TVH server had a different channel list to the one we started with
+                if command.key == CMD_TVH_UPDATE:
+                    (added, removed, changed) = diff_chan_maps(tvh_chan_map, command.arg)
+                    if added or removed or changed:
+                        print(f'TVH channels changed, { len(added) } added, '
+                              f'{ len(removed) } removed, { len(changed) } updated')
+                        # the map is changed in place, a playing channel keeps its own URL
+                        apply_chan_map_diff(tvh_chan_map, added, removed, changed)
+                        if GLOBALS[G_RADIO_MODE] == RM_TVH:
+                            GLOBALS[G_TTS_CACHE].prewarm(added.keys())
+                            chan_names = list(chan_map.keys())
+                            max_chan = len(chan_map)
+                            # stay on the same channel if it still exists
+                            chan_num = find_chan_num(chan_names, GLOBALS[G_CHAN_NAME_FUTURE],
+                                                     chan_num)
+
+                # the streams or favourites file was saved, maybe by someone else
+                elif command.key == CMD_LIST_RELOAD:
+                    if command.arg == STREAMS_LIST:
+                        list_mode = RM_STR
+                        new_map = read_list_file(os.path.join(os.environ['HOME'],
+                                                              SETTINGS_DIR, STREAMS_LIST))
+                        list_diff = diff_chan_maps(streams_chan_map, new_map)
+                        # the streams stay in the order of the file, the map is swapped in place
+                        if any(list_diff):
+                            streams_chan_map.clear()
+                            streams_chan_map.update(new_map)
+                    else:
+                        list_mode = RM_FAV
+                        list_diff = favourites.reload()
+
+                    if list_diff and any(list_diff):
+                        (added, removed, changed) = list_diff
+                        print(f'{ command.arg } changed, { len(added) } added, '
+                              f'{ len(removed) } removed, { len(changed) } updated')
+                        result = f'reloaded { command.arg }'
+                        # the favourite names are changed in place, so the index can't tell
+                        chan_index = None
+                        if GLOBALS[G_RADIO_MODE] == list_mode:
+                            GLOBALS[G_TTS_CACHE].prewarm(added.keys())
+                            if list_mode == RM_FAV:
+                                chan_names = favourites.names
+                            else:
+                                chan_names = list(chan_map.keys())  # get an indexable array
+                            max_chan = len(chan_names)
+                            # stay on the same channel if it still exists
+                            chan_num = find_chan_num(chan_names, GLOBALS[G_CHAN_NAME_FUTURE],
+                                                     chan_num)
+
+                elif command.key == CMD_PROFILE:
+                    if GLOBALS[G_PROFILER]:
+                        report_name = GLOBALS[G_PROFILER].dump('signal')
+                        print(f'Profile written to { report_name }')
+                        result = f'profile written to { report_name }'
+
+                elif command.key == 'A':   # secret key code :-)
+                    api_test_func()
+
+                elif command.key in ('?', 'h'):
+                    print_help()
+
+                #elif command.key == 'l':
+                    #GLOBALS[G_DBG_LEVEL] and print('list')
+                    #print('list')
+                    #print(', '.join(chan_names))
+
+                elif command.key == 'e':
+                    if GLOBALS[G_DBG_LEVEL]: print('e')
+                    streams_editor()
+
+                elif command.key == 'E':
+                    if GLOBALS[G_DBG_LEVEL]: print('E')
+                    channel_editor(chan_map)
+                    #max_chan = len(chan_map)
+                    #chan_names = list(chan_map.keys())  # get an indexable array
+
+                elif command.key == 'f':
+                    if GLOBALS[G_DBG_LEVEL]: print('favourite')
+                    if not chan_names:
+                        print(NO_CHANS_TEXT)
+                        result = 'no channels'
+                    elif favourites.toggle(chan_names[chan_num], chan_map[chan_names[chan_num]]):
+                        print(f'Adding channel { chan_names[chan_num] } to favourites')
+                    else:
+                        print('Removing channel %s to favourites' % (chan_names[chan_num], ))
+                    # re-count the channels, the favourite names are changed in place so
+                    # the search index is rebuilt whichever mode the radio is in
+                    chan_index = None
+                    if GLOBALS[G_RADIO_MODE] == RM_FAV:
+                        max_chan = len(chan_names)
+                        chan_num = max(min(chan_num, max_chan - 1), 0)
+
+                elif command.key == 'F':
+                    if GLOBALS[G_DBG_LEVEL]: print('F')
+                    if favourites:
+                        print('Favourites:')
+                        print_channel_list('\t', favourites)
+                    else:
+                        print('Warning, no favourites set')
+
+
+                elif command.key == 'm':
+                    if GLOBALS[G_DBG_LEVEL]: print('mode')
+                    # if changing mode, kill a running player
+                    stop_playback(threads)
+
+                    # cycle between modes and choose the channel map for new mode
+                    if GLOBALS[G_RADIO_MODE] == RM_TVH:
+                        GLOBALS[G_RADIO_MODE] = RM_STR
+                        chan_map = streams_chan_map
+
+                    elif GLOBALS[G_RADIO_MODE] == RM_STR:
+                        GLOBALS[G_RADIO_MODE] = RM_FAV
+                        chan_map = favourites.urls
+
+                    elif GLOBALS[G_RADIO_MODE] == RM_FAV:
+                        GLOBALS[G_RADIO_MODE] = RM_TVH
+                        chan_map = tvh_chan_map
+                    else:
+                        print('Error, mode change went wrong!')
+
+                    print(f'Debug, mode is now { GLOBALS[G_RADIO_MODE] }')
+                    chan_num = 0                        # start at first channel
+                    if GLOBALS[G_RADIO_MODE] == RM_FAV:
+                        chan_names = favourites.names
+                    else:
+                        chan_names = list(chan_map.keys())  # get an indexable array
+                    max_chan = len(chan_map)            # max channel number
+                    GLOBALS[G_TTS_CACHE].prewarm(chan_names)
+
+
+                elif command.key == 'p':
+                    if GLOBALS[G_DBG_LEVEL]: print('play')
+                    if GLOBALS[G_PLAYER] is not None:
+                        print('Stopping playback')
+                        stop_playback(threads)
+                    elif not chan_names:
+                        print(NO_CHANS_TEXT)
+                        result = 'no channels'
+                    else:
+                        # tidy up after a player which finished by itself
+                        stop_playback(threads)
+                        GLOBALS[G_CHAN_NAME_PLAYING] = chan_names[chan_num]
+                        print(f'attempting to play channel { chan_num }/{ chan_names[chan_num]}')
+                        stream_url = chan_map[chan_names[chan_num]]
+                        feed = GLOBALS[G_PREBUFFER].take(stream_url) \
+                               if GLOBALS[G_PREBUFFER] else None
+                        # relaying or timeshifting, the stream is read here, not by the player
+                        timeshift_bytes = int(float(get_setting(TIMESHIFT_MB)) * 1024 * 1024)
+                        if feed is None and (get_setting(RELAY) == '1' or timeshift_bytes > 0):
+                            feed = StreamFeed(stream_url).start()
+                        if timeshift_bytes > 0:
+                            GLOBALS[G_TIMESHIFT] = TimeshiftBuffer(feed, chan_names[chan_num],
+                                                                   timeshift_bytes).start()
+                            start_player(threads, stream_url, timeshift=GLOBALS[G_TIMESHIFT],
+                                         start_pos=GLOBALS[G_TIMESHIFT].live_pos,
+                                         requested=command.posted)
+                        else:
+                            start_player(threads, stream_url, feed, requested=command.posted)
+
+                elif command.key == 'P':
+                    timeshift = GLOBALS[G_TIMESHIFT]
+                    if timeshift is None:
+                        print('Warning, pause needs the timeshift buffer, use p to stop')
+                        result = 'no timeshift buffer'
+                    elif timeshift.paused_pos is None:
+                        # keep reading the stream, just stop the player, what it
+                        # was given but hadn't played yet is heard on resume
+                        timeshift.paused_pos = timeshift.heard_pos()
+                        stop_playback(threads, True)
+                        print('Paused')
+                        result = 'paused'
+                    else:
+                        resume_pos = max(timeshift.paused_pos, timeshift.oldest_pos())
+                        if resume_pos != timeshift.paused_pos:
+                            print('Warning, paused for longer than the timeshift buffer holds')
+                        timeshift.paused_pos = None
+                        GLOBALS[G_CHAN_NAME_PLAYING] = timeshift.chan_name
+                        start_player(threads, timeshift.feed.url, timeshift=timeshift,
+                                     start_pos=resume_pos, requested=command.posted)
+                        print(f'Resumed, { timeshift.secs_behind(resume_pos):.0f} '
+                              'seconds behind live')
+                        result = 'resumed'
+
+                elif command.key == 'b':
+                    timeshift = GLOBALS[G_TIMESHIFT]
+                    if timeshift is None:
+                        print('Warning, rewind needs the timeshift buffer')
+                        result = 'no timeshift buffer'
+                    else:
+                        from_pos = timeshift.heard_pos() if timeshift.paused_pos is None \
+                                   else timeshift.paused_pos
+                        rewind_bytes = int(timeshift.bytes_per_sec() * TIMESHIFT_REWIND_SECS)
+                        rewind_pos = max(from_pos - rewind_bytes, timeshift.oldest_pos())
+                        stop_playback(threads, True)
+                        timeshift.paused_pos = None
+                        GLOBALS[G_CHAN_NAME_PLAYING] = timeshift.chan_name
+                        start_player(threads, timeshift.feed.url, timeshift=timeshift,
+                                     start_pos=rewind_pos, requested=command.posted)
+                        print(f'Rewound, { timeshift.secs_behind(rewind_pos):.0f} '
+                              'seconds behind live')
+                        result = 'rewound'
+
+                elif command.key == 'q':
+                    print('Quit!')
+                    GLOBALS[G_QUIT_FLAG] = 1
+
+                elif command.key == 'r':
+                    if GLOBALS[G_RECORDER]:
+                        print('Stopping recording')
+                        GLOBALS[G_RECORDER].stop()
+                        GLOBALS[G_RECORDER] = None
+                        result = 'recording stopped'
+                    else:
+                        # record from the stream already being read, if there is one, it
+                        # stays open for the recording when the player stops
+                        timeshift = GLOBALS[G_TIMESHIFT]
+                        if GLOBALS[G_PLAYING_FEED]:
+                            (feed, record_name) = (GLOBALS[G_PLAYING_FEED].share(),
+                                                   GLOBALS[G_CHAN_NAME_PLAYING])
+                        elif timeshift and not timeshift.closed:
+                            (feed, record_name) = (timeshift.feed.share(), timeshift.chan_name)
+                        else:
+                            # the player is reading the stream itself, or nothing is playing
+                            record_name = GLOBALS[G_CHAN_NAME_PLAYING] if GLOBALS[G_PLAYER] else ''
+                            if record_name not in chan_map:
+                                record_name = chan_names[chan_num] if chan_names else ''
+                            feed = None
+                        if not record_name:
+                            print(NO_CHANS_TEXT)
+                            result = 'no channels'
+                        else:
+                            if feed is None:
+                                feed = StreamFeed(chan_map[record_name]).start()
+                            GLOBALS[G_RECORDER] = Recorder(feed, record_name).start()
+                            recorders = [rec for rec in recorders if rec.thread.is_alive()]
+                            recorders.append(GLOBALS[G_RECORDER])
+                            print(f'Recording { record_name }')
+                            result = f'recording { record_name }'
+
+                elif command.key == 's':
+                    if GLOBALS[G_CHAN_NAME_PLAYING]:
+                        tts_file = chan_data_to_tts_file(GLOBALS[G_CHAN_NAME_PLAYING])
+                        if tts_file:
+                            play_file(tts_file)
+                    else:
+                        print('Debug, not playing a channel so not speaking it\'s name')
+
+                elif command.key == 'S':
+                    if GLOBALS[G_CHAN_NAME_FUTURE]:
+                        print(f'Debug, speaking future channel name { GLOBALS[G_CHAN_NAME_FUTURE]}')
+                        tts_file = chan_data_to_tts_file(GLOBALS[G_CHAN_NAME_FUTURE])
+                        if tts_file:
+                            play_file(tts_file)
+                    else:
+                        print(NO_CHANS_TEXT)
+
+                elif command.key == 't':
+                    play_time()
+
+                elif command.key == CMD_SEARCH:
+                    if chan_index is None or chan_index.chan_names is not chan_names:
+                        chan_index = ChannelIndex(chan_names, GLOBALS[G_TVH_CHAN_NUMBERS]
+                                                  if GLOBALS[G_RADIO_MODE] == RM_TVH else None)
+                    found_num = chan_index.search(command.arg)
+                    if found_num is None:
+                        print(f'No channel matches "{ command.arg }"')
+                        result = f'no channel matches { command.arg }'
+                    else:
+                        chan_num = found_num
+
+                elif command.key == CMD_MOVE:
+                    # any run of u (up) and d (down) is merged into one move
+                    if GLOBALS[G_DBG_LEVEL]: print(f'move { command.arg }')
+                    new_num = max(min(chan_num + command.arg, max_chan - 1), 0)
+                    if get_setting(PROBE_SKIP_DEAD) == '1' and new_num != chan_num:
+                        new_num = skip_dead_chans(chan_names, chan_map, new_num,
+                                                  1 if command.arg > 0 else -1)
+                    chan_num = new_num
 
-            elif GLOBALS[G_KEY_STROKE] == 'm':
-                if GLOBALS[G_RADIO_MODE] == RM_TVH:
-                    GLOBALS[G_RADIO_MODE] = RM_STR
                 else:
-                    GLOBALS[G_RADIO_MODE] = RM_TVH
-                    get_tvh_chan_urls()
-                print(f'Mode now { GLOBALS[G_RADIO_MODE] }')
-
-            else:
-                print('Unknown key')
-
-            GLOBALS[G_KEY_STROKE] = ''
-        else:
-            print(f'Error, unknown command key "{ GLOBALS[G_KEY_STROKE] }"')
-
-        GLOBALS[G_CHAN_NUM_FUTURE] = chan_num
-        GLOBALS[G_CHAN_NAME_FUTURE] = chan_names[chan_num]
-        GLOBALS[G_EVENT].clear() # Resets the flag.
-        print(f'Current channel: { G_CHAN_NAME_PLAYING }')
-        print(f'Future channel: { GLOBALS[G_CHAN_NAME_FUTURE] }')
-
-    if httpd:
-        print('Waiting for web service to shut down')
-        httpd.shutdown()
-        time.sleep(1)
-
-    for thread_name in threads:
-        print(f'Debug, joining thread { thread_name } to this')
-        threads[thread_name].join()
+                    print('Unknown key')
+                    result = 'unknown key'
+
+                # a mode can be empty, such as TVH before the server has answered
+                GLOBALS[G_CHAN_NUM_FUTURE] = chan_num
+                GLOBALS[G_CHAN_NAME_FUTURE] = chan_names[chan_num] if chan_names else ''
+                GLOBALS[G_CHAN_URL_FUTURE] = chan_map[chan_names[chan_num]] if chan_names else ''
+                command.finish(result or f'future channel { GLOBALS[G_CHAN_NAME_FUTURE] }')
+                publish_status()
+
+                # any key can be pressed, so unknown ones are counted together
+                metric_command = 'unknown' if result == 'unknown key' else command.key
+                GLOBALS[G_METRICS].command_wait.observe(command_started - command.posted,
+                                                        command=metric_command)
+                GLOBALS[G_METRICS].command_run.observe(time.monotonic() - command_started,
+                                                       command=metric_command)
+
+                # get ready to play the future channel if the user stays on it
+                if GLOBALS[G_PREBUFFER] and not GLOBALS[G_QUIT_FLAG]:
+                    if GLOBALS[G_CHAN_URL_FUTURE] and \
+                       GLOBALS[G_CHAN_NAME_FUTURE] != GLOBALS[G_CHAN_NAME_PLAYING]:
+                        GLOBALS[G_PREBUFFER].select(GLOBALS[G_CHAN_URL_FUTURE])
+                    else:
+                        GLOBALS[G_PREBUFFER].cancel()
+                print(f'Current channel: { G_CHAN_NAME_PLAYING }')
+                print(f'Future channel: { GLOBALS[G_CHAN_NAME_FUTURE] }')
+
+    finally:
+        GLOBALS[G_QUIT_FLAG] = 1
+        # CTRL-C sets the quit flag without the 'q' being handled, so stop playing here
+        stop_playback(threads)
+
+        # the recording threads are joined with the others
+        recorder = GLOBALS[G_RECORDER]
+        if recorder:
+            recorder.stop()
+
+        # wake any background threads which are waiting to do something
+        GLOBALS[G_SHUTDOWN].set()
+        GLOBALS[G_STATUS].wake()
+        GLOBALS[G_TTS_CACHE].shutdown()
+        favourites.flush()
+        if GLOBALS[G_PREBUFFER]:
+            GLOBALS[G_PREBUFFER].cancel()
+
+        if httpd:
+            print('Waiting for web service to shut down')
+            httpd.shutdown()
+            httpd.server_close()
+
+        for thread_name in threads:
+            print(f'Debug, joining thread { thread_name } to this')
+            threads[thread_name].join()
+        for recorder in recorders:
+            recorder.thread.join()
+
+        if GLOBALS[G_TVH_CLIENT]:
+            GLOBALS[G_TVH_CLIENT].close()
+        GLOBALS[G_SHUTDOWN].close()
 
 
 ##########################################################################################
@@ -1034,12 +4108,40 @@ def main():
                         action="store_true", help='increase the debug level')
     parser.add_argument('-s', '--setup', required=False,
                         action="store_true", help='run the setup process')
+    parser.add_argument('--tts-benchmark', required=False,
+                        action="store_true", help='time each speech engine and exit')
+    parser.add_argument('--probe', required=False,
+                        action="store_true", help='check how quickly each stream answers and exit')
+    parser.add_argument('--daemon', required=False,
+                        action="store_true", help='run without a terminal, for systemd, '
+                                                  'controlled by the web or --send')
+    parser.add_argument('--send', required=False, nargs='+', metavar='COMMAND',
+                        help='send commands to the running radio and exit; a key such as p, '
+                             '/ and text to search for, or status')
+    parser.add_argument('--profile', required=False,
+                        action="store_true", help='profile CPU and memory use, written on quit '
+                                                  f'or SIGUSR1 to ~/{ SETTINGS_DIR }/{ PROFILES_DIR }')
     args = parser.parse_args()
 
+    if args.tts_benchmark:
+        tts_benchmark()
+        return
+
+    if args.probe:
+        probe_report()
+        return
+
+    if args.send:
+        sys.exit(control_client(args.send))
+
     if args.debug:
         GLOBALS[G_DBG_LEVEL] += 1
         print(f'Debug, increased debug level to { GLOBALS[G_DBG_LEVEL] }')
 
+    if args.daemon and config_bad < 0:
+        print(f'Error, settings need fixing before running as a daemon, { error_text }')
+        sys.exit(1)
+
     if args.setup or config_bad < 0:
         if config_bad < -1:
             print('Error, severe problem with settings, please fix and restart program')
@@ -1049,25 +4151,55 @@ def main():
             print(f'{ error_text}')
         settings_editor(settings_file)
     else:
-        radio_app()
+        if args.profile:
+            GLOBALS[G_PROFILER] = Profiler().start()
+        try:
+            radio_app(args.daemon)
+        finally:
+            if GLOBALS[G_PROFILER]:
+                print(f'Profile written to { GLOBALS[G_PROFILER].dump("quit") }')
 
 
 ##########################################################################################
+def init_globals():
+    ''' sets every global to its starting value, before main() or radio_app() '''
 
-if __name__ == "__main__":
+    global GLOBALS
 
-    # initialise all globals
     GLOBALS[G_CHAN_NUM_FUTURE]  = 0         # the channel chosen but not playing
+    GLOBALS[G_CHAN_NAME_FUTURE] = ''        # its name, empty until there are channels
     GLOBALS[G_CHAN_NAME_PLAYING] = ''       # the channel currently playing
+    GLOBALS[G_CHAN_URL_FUTURE]  = ''        # the URL of the channel chosen
     GLOBALS[G_DBG_LEVEL]        = 0         #
-    GLOBALS[G_EVENT]            = Event()   # global event handler
-    GLOBALS[G_KEY_STROKE]       = ''        # no key been pressed
+    GLOBALS[G_COMMANDS]         = queue.SimpleQueue()   # commands for the main loop
     GLOBALS[G_MY_SETTINGS]      = configparser.ConfigParser() # configuration are global
+    GLOBALS[G_METRICS]          = RadioMetrics() # latencies for the web /metrics
+    GLOBALS[G_PLAYER]           = None      # not playing
     GLOBALS[G_PLAYER_PID]       = 0         # not playing
+    GLOBALS[G_PLAYING_FEED]     = None      # the feed the player reads, if it has one
+    GLOBALS[G_PREBUFFER]        = None      # made when the radio starts, if enabled
+    GLOBALS[G_PROFILER]         = None      # made by --profile
+    GLOBALS[G_PROBER]           = None      # made when the radio starts or for --probe
     GLOBALS[G_QUIT_FLAG]        = False     # quit not triggered
     GLOBALS[G_RADIO_MODE]       = RM_FAV    # default
+    GLOBALS[G_RECORDER]         = None      # the recording in progress
+    GLOBALS[G_STATUS]           = RadioStatus() # what the web interface shows
+    GLOBALS[G_WEB_ASSETS]       = {}        # loaded when the web server starts
+    if GLOBALS.get(G_SHUTDOWN):
+        GLOBALS[G_SHUTDOWN].close()
+    GLOBALS[G_SHUTDOWN]         = ShutdownEvent() # set when background threads should finish
     GLOBALS[G_STOP_PLAYBACK]    = False     # playback stop triggered
+    GLOBALS[G_TIMESHIFT]        = None      # the pause buffer of the playing channel
+    GLOBALS[G_TTS_CACHE]        = None      # made when the radio starts
+    GLOBALS[G_TVH_CHAN_NUMBERS] = {}        # TVH channel name => channel number
+    GLOBALS[G_TVH_CLIENT]       = None      # made when first needed
+
+
+##########################################################################################
+
+if __name__ == "__main__":
 
+    init_globals()
     main()
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for tvh_radio.py.
+Runs the radio against a stand-in TV Headend server and a stub player and times
+the slow operations, startup, fetching channels, playing, changing mode,
+control socket commands, checking streams and quitting, so that changes which
+make them slower can be caught.
+'''
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import tvh_radio
+
+
+BENCH_USER = 'bench'
+BENCH_PASS = 'bench'
+BENCH_PAUTH = 'benchtoken'
+BENCH_REALM = 'tvheadend'
+BENCH_STREAMS = 50                  # internet streams in the streams list
+BENCH_FAVOURITES = 5                # favourites, so every mode has channels
+
+STREAM_RATE = 16 * 1024             # bytes a second the fake streams send, 128kbit/s
+STREAM_CHUNK = 1024                 # bytes sent at a time
+FIRST_BYTE_TIMEOUT = 10             # seconds to wait for the stub player to hear anything
+
+DEFAULT_SIZES = '100,1000,10000'
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 20              # percent slower than the baseline which is a regression
+
+ENV_NOTIFY = 'TVH_RADIO_BENCH_NOTIFY'   # fifo the stub player writes to on its first byte
+
+
+##########################################################################################
+class FakeTVHHandler(BaseHTTPRequestHandler):
+    ''' a stand-in TV Headend server: the channel grid behind digest auth, paged
+        with start and limit, streams authorised by the persistent auth token, and
+        internet radio streams without any auth, which may be redirected '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):   # pylint:disable=arguments-differ
+        pass
+
+    def do_GET(self):   # pylint:disable=invalid-name
+        ''' implement the http GET method '''
+
+        (_scheme, _netloc, uri, query, _fragment) = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(query)
+
+        if uri == '/api/channel/grid':
+            if self.check_digest():
+                self.send_grid(params)
+            else:
+                self.send_challenge()
+        elif uri.startswith('/stream/channel/'):
+            if params.get('AUTH', [''])[0] == BENCH_PAUTH:
+                self.send_stream()
+            else:
+                self.send_error(403)
+        elif uri.startswith('/radio/'):
+            self.send_stream()
+        elif uri.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', uri[len('/redirect'):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    def check_digest(self):
+        ''' returns True if the request has a good digest Authorization header '''
+
+        auth_header = self.headers.get('Authorization', '')
+        if not auth_header.startswith('Digest '):
+            return False
+
+        auth = {}
+        for auth_part in urllib.request.parse_http_list(auth_header[len('Digest '):]):
+            (auth_key, _sep, auth_value) = auth_part.partition('=')
+            auth[auth_key.strip()] = auth_value.strip().strip('"')
+        if auth.get('nonce') != self.server.nonce or auth.get('username') != BENCH_USER:
+            return False
+
+        ha1 = hashlib.md5(f'{ BENCH_USER }:{ BENCH_REALM }:{ BENCH_PASS }'.encode()).hexdigest()
+        ha2 = hashlib.md5(f'GET:{ auth.get("uri", "") }'.encode()).hexdigest()
+        expected = hashlib.md5(f'{ ha1 }:{ auth["nonce"] }:{ auth.get("nc", "") }:'
+                               f'{ auth.get("cnonce", "") }:{ auth.get("qop", "") }:{ ha2 }'
+                               .encode()).hexdigest()
+        return auth.get('response') == expected
+
+    def send_challenge(self):
+        ''' asks the client to authenticate '''
+
+        self.send_response(401)
+        self.send_header('WWW-Authenticate', f'Digest realm="{ BENCH_REALM }", qop="auth", '
+                                             f'nonce="{ self.server.nonce }", algorithm=MD5')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_grid(self, params):
+        ''' sends a page of the synthetic channel grid '''
+
+        chan_count = self.server.chan_count
+        chan_start = int(params.get('start', ['0'])[0])
+        chan_limit = int(params.get('limit', [str(chan_count)])[0])
+        entries = [{'name': f'Channel { chan_num:05d}', 'uuid': f'{ chan_num:032x}',
+                    'number': chan_num + 1}
+                   for chan_num in range(chan_start, min(chan_start + chan_limit, chan_count))]
+        body = json.dumps({'entries': entries, 'total': chan_count}).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self):
+        ''' sends an endless stream at STREAM_RATE until the client goes away '''
+
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        chunk = bytes(STREAM_CHUNK)
+        try:
+            while not self.server.stopping:
+                self.wfile.write(chunk)
+                time.sleep(STREAM_CHUNK / STREAM_RATE)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+##########################################################################################
+def start_fake_tvh(chan_count):
+    ''' starts the fake server with a grid of chan_count channels, returns it '''
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTVHHandler)
+    server.daemon_threads = True
+    server.chan_count = chan_count
+    server.nonce = os.urandom(16).hex()
+    server.stopping = False
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+##########################################################################################
+def stop_fake_tvh(server):
+    ''' stops the fake server and ends its streams '''
+
+    server.stopping = True
+    server.shutdown()
+    server.server_close()
+
+
+##########################################################################################
+def stub_player(play_arg):
+    ''' stands in for the player: reads the stream from stdin or its URL, says when
+        the first byte arrives, and carries on until it's terminated. Played speech
+        files are just read. '''
+
+    if play_arg == '-':
+        stream = sys.stdin.buffer
+    elif play_arg.startswith('http'):
+        stream = urllib.request.urlopen(play_arg, timeout=FIRST_BYTE_TIMEOUT)
+    else:
+        with open(play_arg, 'rb') as fh_audio:
+            fh_audio.read()
+        return
+
+    notified = False
+    while True:
+        data = stream.read(STREAM_CHUNK)
+        if not data:
+            break
+        if not notified and os.environ.get(ENV_NOTIFY):
+            with open(os.environ[ENV_NOTIFY], 'w') as fh_notify:
+                fh_notify.write(f'{ os.getpid() }\n')
+            notified = True
+
+
+##########################################################################################
+class FirstByteListener():
+    ''' collects the times stub players say they got their first byte, through a
+        fifo so the player doesn't need to know anything about the benchmark '''
+
+    def __init__(self, fifo_path):
+        self.fifo_path = fifo_path
+        os.mkfifo(fifo_path)
+        self.times = queue.SimpleQueue()
+        # opened for writing too, so it never sees end of file between players
+        self.fifo_fd = os.open(fifo_path, os.O_RDWR)
+        Thread(target=self.listen_thread, daemon=True).start()
+
+    def listen_thread(self):
+        ''' records when each line arrives '''
+
+        with os.fdopen(self.fifo_fd, 'r') as fh_fifo:
+            for _line in fh_fifo:
+                self.times.put(time.monotonic())
+
+    def clear(self):
+        ''' forgets first bytes from earlier players '''
+
+        while not self.times.empty():
+            self.times.get()
+
+    def wait(self):
+        ''' returns the time of the next first byte, or None on timeout '''
+
+        try:
+            return self.times.get(timeout=FIRST_BYTE_TIMEOUT)
+        except queue.Empty:
+            return None
+
+
+##########################################################################################
+class BenchSpeech(tvh_radio.TTSBackend):
+    ''' speech which is a moment of silence made in-process, so the timings don't
+        depend on the internet or on a speech engine '''
+
+    name = 'bench'
+    extension = 'wav'
+
+    def to_file(self, input_text, output_file):
+        with wave.open(output_file, 'wb') as wav_out:
+            wav_out.setparams((1, 2, 8000, 0, 'NONE', 'not compressed'))
+            wav_out.writeframes(bytes(800))
+
+
+##########################################################################################
+class Timings():
+    ''' the times taken by each operation, by name '''
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name, secs):
+        ''' records secs for the named operation, ignoring None '''
+
+        if secs is not None:
+            self.results.setdefault(name, []).append(secs)
+
+    def medians(self):
+        ''' returns a dict of name => median seconds '''
+
+        return {name: statistics.median(times) for (name, times) in self.results.items()}
+
+    def report(self, baseline, threshold):
+        ''' prints each operation and how it compares with the baseline medians,
+            returns the names of those more than threshold percent slower '''
+
+        slower = []
+        for (name, times) in self.results.items():
+            line = f'{ name:<44} min { min(times) * 1000:8.1f}ms  ' \
+                   f'median { statistics.median(times) * 1000:8.1f}ms  ' \
+                   f'max { max(times) * 1000:8.1f}ms  ({ len(times) } runs)'
+            if baseline.get(name):
+                change = (statistics.median(times) / baseline[name] - 1) * 100
+                line += f'  { change:+.0f}%'
+                if change > threshold:
+                    line += ' SLOWER'
+                    slower.append(name)
+            print(line)
+
+        return slower
+
+
+##########################################################################################
+def write_bench_home(home_dir, server_url, chan_count, player_command):
+    ''' writes the settings, streams and favourites files for a run '''
+
+    settings_dir = os.path.join(home_dir, tvh_radio.SETTINGS_DIR)
+    os.makedirs(settings_dir, exist_ok=True)
+
+    settings = {setting: values[tvh_radio.DFLT]
+                for (setting, values) in tvh_radio.SETTINGS_DEFAULTS.items()}
+    settings.update({
+        tvh_radio.TS_URL: server_url,
+        tvh_radio.TS_USER: BENCH_USER,
+        tvh_radio.TS_PASS: BENCH_PASS,
+        tvh_radio.TS_PAUTH: BENCH_PAUTH,
+        tvh_radio.TS_CHN_LIMIT: str(chan_count),
+        tvh_radio.PLAYER_COMMAND: player_command,
+        tvh_radio.WEB_PORT: '0',
+    })
+    with open(os.path.join(settings_dir, tvh_radio.SETTINGS_FILE), 'w') as fh_settings:
+        fh_settings.write(f'[{ tvh_radio.SETTINGS_SECTION }]\n')
+        for (setting, value) in settings.items():
+            fh_settings.write(f'{ setting } = { value }\n'.replace('%', '%%'))
+
+    streams = {f'Stream { stream_num:03d}': f'{ server_url }/radio/{ stream_num }'
+               for stream_num in range(BENCH_STREAMS)}
+    tvh_radio.write_list_file(tvh_radio.STREAMS_HDR,
+                              os.path.join(settings_dir, tvh_radio.STREAMS_LIST), streams)
+    favourites = dict(list(streams.items())[:BENCH_FAVOURITES])
+    tvh_radio.write_list_file(tvh_radio.FAVOURITES_HDR,
+                              os.path.join(settings_dir, tvh_radio.FAVOURITES_LIST), favourites)
+
+    # a big list to time reading
+    big_list = {f'Stream { stream_num:05d}': f'{ server_url }/radio/{ stream_num }'
+                for stream_num in range(chan_count)}
+    tvh_radio.write_list_file(tvh_radio.STREAMS_HDR,
+                              os.path.join(settings_dir, 'bench_list.dat'), big_list)
+
+
+##########################################################################################
+def load_bench_settings(home_dir):
+    ''' starts tvh_radio afresh with the settings in home_dir '''
+
+    os.environ['HOME'] = home_dir
+    tvh_radio.init_globals()
+    settings_dir = os.path.join(home_dir, tvh_radio.SETTINGS_DIR)
+    (config_bad, error_text) = tvh_radio.check_load_config_file(
+        settings_dir, os.path.join(settings_dir, tvh_radio.SETTINGS_FILE))
+    if config_bad:
+        raise RuntimeError(error_text)
+
+
+##########################################################################################
+def bench_functions(home_dir, chan_count, repeat, timings):
+    ''' times fetching the TVH channels and reading a list file '''
+
+    load_bench_settings(home_dir)
+    list_file = os.path.join(home_dir, tvh_radio.SETTINGS_DIR, 'bench_list.dat')
+
+    for _run in range(repeat):
+        with contextlib.redirect_stdout(None):
+            time_start = time.monotonic()
+            chan_map = tvh_radio.get_tvh_chan_urls()
+            timings.add(f'{ chan_count } get_tvh_chan_urls ({ len(chan_map) } fetched)',
+                        time.monotonic() - time_start)
+
+            time_start = time.monotonic()
+            tvh_radio.read_list_file(list_file)
+            timings.add(f'{ chan_count } read_list_file', time.monotonic() - time_start)
+
+    tvh_radio.GLOBALS[tvh_radio.G_TVH_CLIENT].close()
+
+
+##########################################################################################
+def bench_prober(server, repeat, timings):
+    ''' checks StreamProber tells live streams from dead ones served by the fake
+        server, then times probing as many streams as it checks at once '''
+
+    tvh_radio.init_globals()
+    server_url = f'http://127.0.0.1:{ server.server_port }'
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as closed_sock:
+        closed_sock.bind(('127.0.0.1', 0))
+        closed_url = f'http://127.0.0.1:{ closed_sock.getsockname()[1] }/radio/0'
+
+    # stream URL => whether it should be found to be alive
+    expected = {
+        f'{ server_url }/radio/0': True,
+        f'{ server_url }/redirect/radio/1': True,
+        f'{ server_url }/missing/0': False,
+        closed_url: False,
+    }
+    prober = tvh_radio.StreamProber()
+    prober.probe(expected)
+    for (stream_url, alive) in expected.items():
+        probe = prober.result(stream_url)
+        if probe is None or probe['ok'] != alive:
+            raise RuntimeError(f'Probing { stream_url } gave { probe }, '
+                               f'it should be { "alive" if alive else "dead" }')
+
+    stream_urls = [f'{ server_url }/radio/{ stream_num }'
+                   for stream_num in range(tvh_radio.PROBE_WORKERS)]
+    for _run in range(repeat):
+        time_start = time.monotonic()
+        prober.probe(stream_urls)
+        timings.add(f'probe { len(stream_urls) } streams', time.monotonic() - time_start)
+
+
+##########################################################################################
+def bench_radio_app(home_dir, chan_count, repeat, listener, timings, cache_state):
+    ''' runs radio_app, scripted by posting commands from another thread, and
+        times startup, play to first byte, stop, mode changes and quit '''
+
+    load_bench_settings(home_dir)
+    tvh_radio.GLOBALS[tvh_radio.G_RADIO_MODE] = tvh_radio.RM_TVH
+    prefix = f'{ chan_count } { cache_state }'
+
+    quit_posted = []
+
+    def wait_command(key, arg=None):
+        time_start = time.monotonic()
+        tvh_radio.post_command(key, arg).wait()
+        return time.monotonic() - time_start
+
+    def script():
+        # the first command is finished once the radio is taking input
+        tvh_radio.post_command(tvh_radio.CMD_MOVE, 0).wait()
+        timings.add(f'{ prefix } startup to input', time.monotonic() - app_start)
+
+        # without a cache, the TVH channels arrive after that
+        (version, state) = tvh_radio.GLOBALS[tvh_radio.G_STATUS].snapshot()
+        while not state['future']:
+            (version, state) = tvh_radio.GLOBALS[tvh_radio.G_STATUS].wait_change(version, 1)
+        timings.add(f'{ prefix } startup to first channel', time.monotonic() - app_start)
+
+        for relay in ('0', '1'):
+            tvh_radio.GLOBALS[tvh_radio.G_MY_SETTINGS].set(tvh_radio.SETTINGS_SECTION,
+                                                          tvh_radio.RELAY, relay)
+            relayed = ' relayed' if relay == '1' else ''
+            for _run in range(repeat):
+                listener.clear()
+                time_start = time.monotonic()
+                tvh_radio.post_command('p').wait()
+                first_byte = listener.wait()
+                timings.add(f'{ prefix } play to first byte{ relayed }',
+                            first_byte - time_start if first_byte else None)
+                timings.add(f'{ prefix } stop{ relayed }', wait_command('p'))
+
+        for _run in range(repeat):
+            for _mode in range(3):
+                timings.add(f'{ prefix } mode change', wait_command('m'))
+
+        # a request and its reply on the control socket, as tvh_radio.py --send does
+        control_path = os.path.join(home_dir, tvh_radio.SETTINGS_DIR, tvh_radio.CONTROL_SOCKET)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control_sock:
+            control_sock.connect(control_path)
+            with control_sock.makefile('rb') as control_reader:
+                for _run in range(repeat):
+                    time_start = time.monotonic()
+                    control_sock.sendall(b'u\n')
+                    control_reader.readline()
+                    timings.add(f'{ prefix } control socket command', time.monotonic() - time_start)
+
+        quit_posted.append(time.monotonic())
+        tvh_radio.post_command('q')
+
+    script_thread = Thread(target=script)
+    with contextlib.redirect_stdout(None):
+        app_start = time.monotonic()
+        script_thread.start()
+        tvh_radio.radio_app(daemon=True)
+        timings.add(f'{ prefix } quit', time.monotonic() - quit_posted[0])
+    script_thread.join()
+
+
+##########################################################################################
+def main():
+    ''' the main entry point '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated numbers of channels in the fake grid')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='times to repeat each operation')
+    parser.add_argument('--json', help='file to save the median timings in')
+    parser.add_argument('--baseline', help='timings saved by --json to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='percent slower than the baseline which fails the run')
+    parser.add_argument('--stub-player', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stub_player is not None:
+        stub_player(args.stub_player[-1])
+        return 0
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as fh_baseline:
+            baseline = json.load(fh_baseline)
+
+    # the radio must not take over the terminal, and speaks silence
+    sys.stdin = open(os.devnull, 'r')
+    tvh_radio.make_tts_backend = lambda tts_engine: BenchSpeech()
+
+    timings = Timings()
+    with tempfile.TemporaryDirectory(prefix='tvh_radio_bench') as bench_dir:
+        listener = FirstByteListener(os.path.join(bench_dir, 'first_byte'))
+        os.environ[ENV_NOTIFY] = listener.fifo_path
+        player_command = f'{ sys.executable } { os.path.abspath(__file__) } --stub-player'
+
+        server = start_fake_tvh(0)
+        try:
+            bench_prober(server, args.repeat, timings)
+        finally:
+            stop_fake_tvh(server)
+
+        for chan_count in [int(size) for size in args.sizes.split(',')]:
+            print(f'Benchmarking with { chan_count } channels', file=sys.stderr)
+            server = start_fake_tvh(chan_count)
+            home_dir = os.path.join(bench_dir, f'home{ chan_count }')
+            write_bench_home(home_dir, f'http://127.0.0.1:{ server.server_port }',
+                             chan_count, player_command)
+            try:
+                bench_functions(home_dir, chan_count, args.repeat, timings)
+                # the first run has no channel cache, the second uses it
+                for cache_state in ('cold', 'cached'):
+                    bench_radio_app(home_dir, chan_count, args.repeat, listener, timings,
+                                    cache_state)
+            finally:
+                stop_fake_tvh(server)
+
+    slower = timings.report(baseline, args.threshold)
+
+    if args.json:
+        with open(args.json, 'w') as fh_json:
+            json.dump(timings.medians(), fh_json, indent=2)
+
+    if slower:
+        print(f'{ len(slower) } operations are more than { args.threshold:.0f}% slower '
+              'than the baseline')
+        return 1
+
+    return 0
+
+
+##########################################################################################
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4